@@ -0,0 +1,87 @@
+# coding=utf8
+"""Compares grouping by key with the hash-based engine of `pyparade.operations.GroupByKeyOperation`
+to the B+ tree (`pyparade.util.btree.BTree`) it replaced.
+
+For different numbers of distinct keys, (key, value) pairs are grouped in memory by both engines
+and the throughput is printed. With --dataset, the pairs are additionally grouped by a
+`pyparade.Dataset` to measure group_by_key and reduce_by_key end-to-end, and grouped in partitions by the worker processes
+(group_by_key(num_partitions=...)).
+
+Usage:
+	python benchmarks/group_by_key.py [--dataset] [--pairs N]
+"""
+from __future__ import print_function
+from __future__ import division
+import argparse, operator, random, time, multiprocessing
+
+import pyparade
+from pyparade.util.btree import BTree
+
+def pairs(n, distinct_keys):
+	return [(random.randrange(distinct_keys), i) for i in range(n)]
+
+def group_btree(pairs, sort):
+	tree = BTree(10, None, None)
+	for k, v in pairs:
+		if k in tree:
+			tree[k].append(v)
+		else:
+			tree[k] = [v]
+	return [(k, v) for key, leaf in tree.get_leafs() for k, v in zip(leaf.keys, leaf.values)]
+
+def group_hash(pairs, sort):
+	groups = {}
+	for k, v in pairs:
+		if k in groups:
+			groups[k].append(v)
+		else:
+			groups[k] = [v]
+	keys = sorted(groups) if sort else groups
+	return [(k, groups[k]) for k in keys]
+
+ENGINES = [
+	("btree", group_btree, False),
+	("hash", group_hash, False),
+	("hash sorted", group_hash, True)
+]
+
+def bench(group, pairs, sort):
+	start = time.time()
+	group(pairs, sort)
+	return time.time() - start
+
+def bench_dataset(pairs, sort):
+	start = time.time()
+	pyparade.Dataset(pairs).group_by_key(sort = sort).collect(status = False)
+	grouped = time.time() - start
+	start = time.time()
+	pyparade.Dataset(pairs).reduce_by_key(operator.add, sort = sort).collect(status = False)
+	return grouped, time.time() - start
+
+def bench_partitioned(pairs, num_partitions):
+	start = time.time()
+	pyparade.Dataset(pairs).group_by_key(num_partitions = num_partitions).collect(status = False)
+	return time.time() - start
+
+def main():
+	parser = argparse.ArgumentParser(description="Compares grouping by key using a hash table and a B+ tree")
+	parser.add_argument("--pairs", type=int, default=200000, help="the number of (key, value) pairs")
+	parser.add_argument("--dataset", action="store_true", help="also measure group_by_key and reduce_by_key of a Dataset")
+	args = parser.parse_args()
+
+	for distinct_keys in [10, 1000, 100000]:
+		data = pairs(args.pairs, distinct_keys)
+		print("%d pairs, %d distinct keys" % (len(data), distinct_keys))
+		for name, group, sort in ENGINES:
+			seconds = bench(group, data, sort)
+			print("  %-12s %12.0f pairs/s" % (name, len(data)/seconds))
+		if args.dataset:
+			for sort in [False, True]:
+				grouped, reduced = bench_dataset(data, sort)
+				print("  %-12s %12.0f pairs/s group_by_key %12.0f pairs/s reduce_by_key" % ("dataset" + (" sorted" if sort else ""), len(data)/grouped, len(data)/reduced))
+			num_partitions = 4*multiprocessing.cpu_count()
+			seconds = bench_partitioned(data, num_partitions)
+			print("  %-12s %12.0f pairs/s group_by_key in %d partitions" % ("partitioned", len(data)/seconds, num_partitions))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,86 @@
+# coding=utf8
+"""Compares the serializers of `pyparade.util` on typical record shapes.
+
+For each record shape and serializer, a batch of records is serialized and deserialized repeatedly
+and the throughput and serialized size are printed. With --parmap, the records are additionally
+sent through a `pyparade.util.ParMap` with an identity function to measure the end-to-end throughput.
+
+Usage:
+	python benchmarks/serializers.py [--parmap] [--batch-size N] [--repeat N]
+"""
+from __future__ import print_function
+from __future__ import division
+import argparse, random, string, time
+
+import pyparade.util
+from pyparade.util import ParMap, SERIALIZERS, get_serializer, deserialize
+
+def word_counts(n):
+	return [("".join(random.choice(string.ascii_lowercase) for i in range(8)), random.randint(1, 1000)) for i in range(n)]
+
+def rows(n):
+	return [{"id": i, "name": "user %d" % i, "score": random.random(), "tags": ["a", "b", "c"]} for i in range(n)]
+
+def text_lines(n):
+	words = ["the", "quick", "brown", "fox", "jumps", "over", "lazy", "dog"]
+	return [" ".join(random.choice(words) for i in range(20)) for i in range(n)]
+
+def float_vectors(n):
+	return [[random.random() for i in range(100)] for i in range(n)]
+
+def blobs(n):
+	return [bytes(bytearray(random.getrandbits(8) for i in range(64))) * 1024 for i in range(n // 10 + 1)]
+
+SHAPES = [
+	("word counts", word_counts),
+	("dict rows", rows),
+	("text lines", text_lines),
+	("float vectors", float_vectors),
+	("64 kB blobs", blobs)
+]
+
+def identity(value):
+	return value
+
+def available_serializers():
+	names = sorted(SERIALIZERS.keys())
+	if pyparade.util.cloudpickle == None:
+		names.remove("cloudpickle")
+	return names
+
+def bench_roundtrip(serializer, records, repeat):
+	size = 0
+	start = time.time()
+	for i in range(repeat):
+		data = serializer.dumps(records)
+		deserialize(data)
+		size = len(data)
+	return (time.time() - start)/repeat, size
+
+def bench_parmap(name, records, repeat):
+	start = time.time()
+	for i in range(repeat):
+		for value in ParMap(identity, serializer = name).map(records * 10):
+			pass
+	return (time.time() - start)/repeat
+
+def main():
+	parser = argparse.ArgumentParser(description="Compares the serializers of pyparade on typical record shapes")
+	parser.add_argument("--batch-size", type=int, default=1000, help="the number of records in a batch")
+	parser.add_argument("--repeat", type=int, default=20, help="the number of repetitions")
+	parser.add_argument("--parmap", action="store_true", help="also measure the end-to-end throughput of a ParMap")
+	args = parser.parse_args()
+
+	for shape, create in SHAPES:
+		records = create(args.batch_size)
+		print("%s (%d records)" % (shape, len(records)))
+		for name in available_serializers():
+			seconds, size = bench_roundtrip(get_serializer(name), records, args.repeat)
+			line = "  %-12s %10.0f records/s %12d bytes" % (name, len(records)/seconds, size)
+			if args.parmap:
+				seconds = bench_parmap(name, records, max(1, args.repeat // 10))
+				line += " %10.0f records/s through ParMap" % (10*len(records)/seconds)
+			print(line)
+
+if __name__ == "__main__":
+	main()
@@ -6,9 +6,12 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import str
 from builtins import object
-import queue, threading, time, sys, datetime, multiprocessing, signal, threading, sys, itertools
+import queue, threading, time, sys, datetime, multiprocessing, signal, threading, sys, itertools, collections, tempfile, pickle, os, functools, traceback, locale
 
 from . import operations
+from .operations import FlushPolicy
+from . import util
+from .util import WorkerPool, MemoryBudget, ByteOffsetEstimator, FileSizeEstimator
 
 TERMINAL_WIDTH = 80
 
@@ -24,15 +27,31 @@ def _signal_handler(signal, frame):
 		print("Aborting " + proc.name + " (can take a minute)...")
 		proc.stop()
 
+class LengthNotAvailableError(RuntimeError, TypeError):
+	"""Raised by len() of a `pyparade.Dataset` whose length is not known (yet). It is a TypeError as well, 
+	such that list() and other consumers of iterables fall back to `pyparade.Dataset.__length_hint__`."""
+	pass
+
 class Dataset(operations.Source):
 	"""Represents a dataset (can be used as a source, intermediate dataset or result)"""
-	def __init__(self, source, length=None, name=None):
+	def __init__(self, source, length=None, name=None, flush_policy=None, spill_limit=0, buffer_bytes=None, length_hint=None):
 		"""Creates a new dataset
 		Args:
 			source: A source where the data for this dataset is obtained from. An iterable or `pyparade.operations.Source`
 			length: The number of elements in the dataset. Only used, if len(source) is not available
-			name: The display name for the dataset (convention: 1-25 characters starting with a big letter)"""
-		super(Dataset, self).__init__(name)
+			length_hint: An estimate of the number of elements used for progress, ETAs and chunk sizes if the length is not available. 
+						 A number or a function that is called with the number of elements read so far and returns the estimated total 
+						 (or None), e.g. a `pyparade.util.ByteOffsetEstimator`. Defaults to a `pyparade.util.FileSizeEstimator` 
+						 if the source is a file.
+			name: The display name for the dataset (convention: 1-25 characters starting with a big letter)
+			flush_policy: When elements read from an iterable source are passed on to the next operations. 
+						  "default" (every 0.5 seconds), "low_latency" (immediately), "high_throughput" or a `pyparade.FlushPolicy`. 
+						  Operations take a flush_policy argument as well, for example dataset.map(f, flush_policy="low_latency")
+			spill_limit: If the dataset is used by several operations, the number of batches an operation that lags behind 
+						 can spill to disk, such that it does not slow down the others (see `pyparade.BroadcastBuffer`)
+			buffer_bytes: The maximum estimated size in bytes of the elements buffered for each operation reading this dataset 
+						  (None for no limit, see also the memory_limit of `pyparade.ParallelProcess`)"""
+		super(Dataset, self).__init__(name, flush_policy=flush_policy)
 
 		self.source = source
 		self._length = length
@@ -45,6 +64,11 @@ class Dataset(operations.Source):
 			self._length_is_estimated = False
 		else:
 			self._length_is_estimated = True
+		self._counts_length = self._length_is_estimated #the length is counted each time the dataset is filled
+
+		if length_hint == None and self._length_is_estimated:
+			length_hint = util.file_length_hint(source)
+		self.length_hint = length_hint
 
 		if self.name == None:
 			if isinstance(self.source, operations.Source) and self.source.output_name != None: #get name from operation output
@@ -52,62 +76,232 @@ class Dataset(operations.Source):
 			else:
 				self.name = "Dataset" 
 
+		self.buffer_bytes = buffer_bytes
+		self._log = BroadcastBuffer(spill_limit, buffer_bytes)
 		self._buffers = []
+		self._cache = None
 		self.finished = threading.Event()
 
+	@property
+	def spill_limit(self):
+		"""The number of batches each consumer of this dataset can spill to disk when it lags behind the others"""
+		return self._log.spill_limit
+
+	@spill_limit.setter
+	def spill_limit(self, spill_limit):
+		self._log.spill_limit = spill_limit
+
+	@property
+	def length_hint(self):
+		"""An estimate of the number of elements if the length is not available, see `pyparade.Dataset.__init__`"""
+		return self._length_hint
+
+	@length_hint.setter
+	def length_hint(self, length_hint):
+		self._length_hint = length_hint
+		self._length_estimate = length_hint(0) if callable(length_hint) else length_hint
+
 	def __len__(self):
 		if self._length != None:
 			return self._length
 		else:
-			raise RuntimeError("Length is not available")
+			raise LengthNotAvailableError("Length is not available")
 
-	def _get_buffer(self, size = 30):
-		buf = Buffer(self, size=size)
-		self._buffers.append(buf)
-		return buf
+	def __length_hint__(self):
+		"""Returns the estimated number of elements for list() and similar consumers (see `pyparade.Dataset.estimated_length`)"""
+		estimate = self.estimated_length()
+		return estimate if estimate != None else NotImplemented
 
-	def _fill_buffers(self):
-		self.running.set()
-		if isinstance(self.source, operations.Operation):
-			values = self.source()
-		else:
-			values = itertools.chain((value for value in self.source), [operations.OutputEndMarker()])
+	@classmethod
+	def from_partitions(cls, partitions, reader_func, context = None, name = None, length = None, length_hint = None, **kwargs):
+		"""Returns a new `pyparade.Dataset` whose elements are read by the worker processes, each worker reads whole partitions. 
+		Only the partition descriptions are sent to the workers, such that reading is not limited by a single reader in this process.
 
-		if self._length_is_estimated:
-			self._length = 0
+		Args:
+			partitions: An iterable of partition descriptions, for example file names or (first, last) ranges of database ids. 
+						They are sent to the workers and have to be picklable.
+			reader_func: A function that accepts a partition description (and the context object, if a context is given) 
+						 and returns an iterable (or generator) of the elements in the partition.
+			context: A function that returns a context manager, which is entered once for each worker (e.g. a database connection). 
+					 The context object is passed to reader_func as the second argument.
+			name: The display name for the dataset
+			length: The number of elements in all partitions, if it is known
+			length_hint: An estimate of the number of elements in all partitions, see `pyparade.Dataset`
+			**kwargs: Other arguments are passed on to `pyparade.operations.ReadPartitionsOperation`, which is a flat_map 
+					  (for example ordered=False to output partitions in the order they are finished)
 
-		batch = []
-		last_insert = 0
+		Example:
+			>>> import pyparade
+			>>> def read_range(r):
+			... 	return range(r[0], r[1])
+			>>> pyparade.Dataset.from_partitions([(0, 3), (3, 5)], read_range).collect()
+			[0, 1, 2, 3, 4]
+		"""
+		descriptions = cls(partitions, name = "Partitions")
+		op = operations.ReadPartitionsOperation(descriptions, reader_func, context = context, **kwargs)
+		return cls(op, length = length, name = name, length_hint = length_hint)
 
-		for value in values:
-			if self._check_stop():
-				break
+	@classmethod
+	def from_text_file(cls, path, encoding = None, errors = None, partition_bytes = 8*1024*1024, name = None, **kwargs):
+		"""Returns a new `pyparade.Dataset` containing the lines of a text file (including line endings, like iterating over 
+		the opened file). The file is split into byte ranges at line boundaries, which are memory-mapped and parsed by the workers.
+		The number of lines is estimated from the size of the file and the lines read so far.
 
-			while len([buf for buf in self._buffers if buf.full()]) > 0:
-				if self._check_stop():
-					break
-				time.sleep(1)
+		Args:
+			path: The path of the text file
+			encoding: The encoding of the file (defaults to the encoding used by open()). It has to encode line endings 
+				as a single newline byte like ASCII does (e.g. UTF-8 or Latin-1), UTF-16 and UTF-32 are not supported.
+			errors: How encoding errors are handled, see open()
+			partition_bytes: The approximate size in bytes of the ranges read by a worker at once
+			name: The display name for the dataset (defaults to the file name)
+			**kwargs: Other arguments are passed on to `pyparade.Dataset.from_partitions`
 
-			if self._check_stop():
-				break
+		Example:
+			>>> import pyparade
+			>>> pyparade.Dataset.from_text_file("access.log").filter(is_error).collect()
+		"""
+		if "\n".encode(encoding if encoding != None else locale.getpreferredencoding(False)) != b"\n": #ranges are split at newline bytes
+			raise ValueError("Encoding " + str(encoding) + " is not supported, line endings have to be encoded as a single newline byte")
+		partitions = util.text_file_partitions(path, partition_bytes)
+		ends = [end for (p, start, end) in partitions]
+		d = cls.from_partitions(partitions, functools.partial(util.read_text_range, encoding = encoding, errors = errors), 
+			name = name if name != None else os.path.basename(path), **kwargs)
+		op = d.source
+		if d.length_hint == None: #estimate from the file size and the ranges read so far
+			d.length_hint = util.ByteOffsetEstimator(os.path.getsize(path), lambda: ends[op.processed - 1] if op.processed > 0 else 0, 
+				initial = util.estimate_line_count(path))
+		return d
+
+	@classmethod
+	def from_binary_file(cls, path, record_size, partition_bytes = 8*1024*1024, name = None, **kwargs):
+		"""Returns a new `pyparade.Dataset` containing the records of a file of fixed size records as bytes objects 
+		(use map with struct.unpack or numpy.frombuffer to parse them). The file is split into byte ranges of whole records, 
+		which are memory-mapped and read by the workers. Trailing bytes that do not form a whole record are ignored.
 
-			batch.append(value)
+		Args:
+			path: The path of the file
+			record_size: The size of each record in bytes
+			partition_bytes: The approximate size in bytes of the ranges read by a worker at once
+			name: The display name for the dataset (defaults to the file name)
+			**kwargs: Other arguments are passed on to `pyparade.Dataset.from_partitions`
+
+		Example:
+			>>> import pyparade, struct
+			>>> pyparade.Dataset.from_binary_file("points.bin", 16).map(functools.partial(struct.unpack, "<dd")).collect()
+		"""
+		partitions = util.record_file_partitions(path, record_size, partition_bytes)
+		return cls.from_partitions(partitions, functools.partial(util.read_record_range, record_size = record_size), 
+			length = os.path.getsize(path) // record_size, name = name if name != None else os.path.basename(path), **kwargs)
+
+	def _get_buffer(self, size = 30, consumer = None):
+		buf = Buffer(self, size=size, log=self._log, consumer=consumer)
+		self._buffers.append(buf)
+		return buf
 
-			if self._length_is_estimated:
-				if not isinstance(value, operations.OutputEndMarker):
-					self._length += 1
+	def _remove_buffer(self, buf):
+		self._buffers.remove(buf)
+		self._log.remove_consumer(buf)
+		self._notify_space_freed()
 
-			if time.time() - last_insert > 0.5:
-				[buf.put(batch) for buf in self._buffers]
+	def cache(self, storage = "memory"):
+		"""Keeps the elements of this dataset when it is calculated for the first time, such that later processes 
+		that use this dataset (or datasets derived from it) read the stored elements instead of running the operations 
+		this dataset results from again. Returns this dataset.
+
+		Args:
+			storage: "memory" (default) keeps the elements in memory, "disk" stores them in a temporary file 
+					 in a compact binary format, such that the cache can be larger than the available memory
+
+		Example:
+			>>> import pyparade
+			>>> words = pyparade.Dataset(["a b", "c"]).flat_map(str.split).cache()
+			>>> words.map(str.upper).collect() #splits the lines
+			["A", "B", "C"]
+			>>> words.collect() #reads the cached words
+			["a", "b", "c"]
+		"""
+		if self._cache != None:
+			self._cache.clear()
+		self._cache = DatasetCache(storage)
+		return self
+
+	def uncache(self):
+		"""Drops the stored elements of a cached dataset (see `pyparade.Dataset.cache`). Returns this dataset."""
+		if self._cache != None:
+			self._cache.clear()
+			self._cache = None
+		return self
+
+	def is_cached(self):
+		"""Returns True if the elements of this dataset have been calculated and are stored in the cache"""
+		return self._cache != None and self._cache.complete
+
+	def get_parents(self):
+		if self.is_cached(): #operations before this dataset do not need to run again
+			return [self]
+		return super(Dataset, self).get_parents()
+
+	def _generate_batches(self):
+		"""Yields the elements of the source in batches"""
+		if self.is_cached():
+			for batch in self._cache.batches():
+				yield batch
+			return
+
+		if isinstance(self.source, operations.Operation): #operations output batches
+			for batch in self.source():
+				yield batch
+			return
+
+		batch = []
+		last_insert = 0
+		for value in self.source:
+			batch.append(value)
+			if self._flush_policy.should_flush(len(batch), last_insert):
+				yield batch
 				batch = []
 				last_insert = time.time()
+		yield batch
 
-		while len([buf for buf in self._buffers if buf.full()]) > 0:
-			if self._check_stop():
-				break
-			time.sleep(1)
+	def _fill_buffers(self):
+		self.running.set()
+		if self._counts_length and not self.is_cached(): #the number of elements can differ between runs
+			self._length_is_estimated = True
+		combined = getattr(self.source, "combine_func", None) != None #the elements are partial results pre-reduced by the workers
+		if combined:
+			self._length = None
+		elif self._length_is_estimated:
+			self._length = 0
+			self._update_length_estimate()
+		caching = self._cache != None and not self._cache.complete
+		if caching: #discard elements of an incomplete run
+			self._cache.clear()
 
-		[buf.put(batch) for buf in self._buffers]
+		try:
+			for batch in self._generate_batches():
+				if self._check_stop():
+					break
+
+				self._wait_for_space(self._log.full)
+				if self._check_stop():
+					break
+
+				if len(batch) == 0:
+					continue
+				if self._length_is_estimated and not combined:
+					self._length += len(batch)
+					self._update_length_estimate()
+				if caching:
+					self._cache.append(batch)
+				self._log.put(batch)
+			else:
+				if caching and len([s for s in super(Dataset, self).get_parents() if s.exception]) == 0:
+					self._cache.complete = True
+		except BaseException as e: #the source failed, consumers raise the error when they reach the end of the stream
+			ex_type, ex_value, tb = sys.exc_info()
+			self.exception = (ex_type, ex_value, ''.join(traceback.format_tb(tb)))
+		finally:
+			self._log.end()
 
 		self._length_is_estimated = False
 		self.finished.set()
@@ -115,7 +309,7 @@ class Dataset(operations.Source):
 
 	def has_length(self):
 		"""Returns True if the length of this Source is available. 
-		If this function returns False, calling len() on the Source will raise a RuntimeException."""
+		If this function returns False, calling len() on the Source will raise a `pyparade.LengthNotAvailableError`."""
 		return self._length != None
 
 	def length_is_estimated(self):
@@ -123,7 +317,24 @@ class Dataset(operations.Source):
 		for example if not all items in the Source are known yet."""
 		return self._length_is_estimated
 
-	def map(self, map_func, context = None, **kwargs):
+	def _update_length_estimate(self):
+		if callable(self._length_hint):
+			self._length_estimate = self._length_hint(self._length)
+
+	def estimated_length(self):
+		"""Returns the expected number of elements in this dataset or None if it cannot be estimated. 
+		This is the length if it is known, otherwise an estimate based on the length_hint of the dataset 
+		or on the estimated length of the operation it results from (e.g. a map outputs as many elements as its source)."""
+		if not self._length_is_estimated:
+			return self._length
+		estimate = self._length_estimate
+		if estimate == None and isinstance(self.source, operations.Operation) and not self.is_cached():
+			estimate = self.source.estimated_length()
+		if estimate == None:
+			return None
+		return max(estimate, self._length or 0) #there are at least as many elements as have been read
+
+	def map(self, map_func, context = None, transport = "pipe", ordered = True, chunkseconds = 3.0, chunkbytes = 16*1024*1024, serializer = "pickle", **kwargs):
 		"""Returns a new `pyparade.Dataset` which results from applying map_func to each element in this Dataset.
 
 		Supplying a context can be used to establish a connection to a common resource such as a database.
@@ -131,9 +342,20 @@ class Dataset(operations.Source):
 		Args:
 			map_func: The function to be applied to each element. Has to accept an element from this Dataset as the first 
 					  argument and should return a new element which is put into the output Dataset.
-			context: A function that returns a context manager. It is called once for each parallel executor 
+					  Coroutine functions (async def) are run concurrently on an event loop in each worker 
+					  (the number of concurrent calls per worker can be limited using the concurrency argument).
+			context: A function that returns a context manager (or an asynchronous context manager). It is called once for each parallel executor 
 					 which executes map_func. For each call of map_func the context object is passed as the second argument.
-			**kwargs: Other arguments are passed on to `pyparade.operations.MapOperation
+			transport: How elements are transferred to the worker processes. "pipe" (default) or "shared_memory", 
+					   which avoids copying large elements (such as byte blobs or NumPy arrays) through the worker pipes.
+			ordered: If True (default), the output keeps the order of this Dataset. If False, results are output as soon as 
+					 they are calculated, such that slow elements do not hold back the output of others.
+			chunkseconds: The targeted processing time in seconds of a batch of elements sent to a worker (default: 3 seconds)
+			chunkbytes: The maximum size in bytes of a batch of elements and its results (default: 16 MB, None for no limit)
+			serializer: How elements, results and map_func are serialized when sent to the worker processes. "pickle" (default), 
+						"pickle5", "cloudpickle" (allows lambdas and closures with the spawn start method) or "zlib" (compressed pickle)
+			**kwargs: Other arguments are passed on to `pyparade.operations.MapOperation`, for example backend="threads" 
+					  to run map_func in threads, which allows many concurrent calls for I/O bound functions (like database queries)
 
 		Example:
 			>>> import pyparade
@@ -142,10 +364,10 @@ class Dataset(operations.Source):
 			[2,3,4]
 
 		"""
-		op = operations.MapOperation(self, map_func, context = context, **kwargs)
+		op = operations.MapOperation(self, map_func, context = context, transport = transport, ordered = ordered, chunkseconds = chunkseconds, chunkbytes = chunkbytes, serializer = serializer, **kwargs)
 		return Dataset(op)
 
-	def flat_map(self, map_func, context = None, **kwargs):
+	def flat_map(self, map_func, context = None, transport = "pipe", ordered = True, chunkseconds = 3.0, chunkbytes = 16*1024*1024, serializer = "pickle", **kwargs):
 		"""Returns a new `pyparade.Dataset` which results from applying map_func to each element in 
 		this Dataset and combining the returned lists in a flat list.
 
@@ -154,9 +376,19 @@ class Dataset(operations.Source):
 		Args:
 			map_func: The function to be applied to each element. Has to accept an element from this Dataset as the first 
 					  argument and should return an iterable containing elements which are put into the output Dataset.
-			context: A function that returns a context manager. It is called once for each parallel executor 
+					  Coroutine functions (async def) are run concurrently on an event loop in each worker.
+			context: A function that returns a context manager (or an asynchronous context manager). It is called once for each parallel executor 
 					 which executes map_func. For each call of map_func the context object is passed as the second argument.
-			**kwargs: Other arguments are passed on to `pyparade.operations.FlatMapOperation`
+			transport: How elements are transferred to the worker processes. "pipe" (default) or "shared_memory", 
+					   which avoids copying large elements (such as byte blobs or NumPy arrays) through the worker pipes.
+			ordered: If True (default), the output keeps the order of this Dataset. If False, results are output as soon as 
+					 they are calculated, such that slow elements do not hold back the output of others.
+			chunkseconds: The targeted processing time in seconds of a batch of elements sent to a worker (default: 3 seconds)
+			chunkbytes: The maximum size in bytes of a batch of elements and its results (default: 16 MB, None for no limit)
+			serializer: How elements, results and map_func are serialized when sent to the worker processes. "pickle" (default), 
+						"pickle5", "cloudpickle" (allows lambdas and closures with the spawn start method) or "zlib" (compressed pickle)
+			**kwargs: Other arguments are passed on to `pyparade.operations.FlatMapOperation`, for example backend="threads" 
+					  to run map_func in threads, which allows many concurrent calls for I/O bound functions (like database queries)
 
 		Example:
 			>>> import pyparade
@@ -166,7 +398,26 @@ class Dataset(operations.Source):
 			>>> d.flat_map(str.split).collect() #split by space and flat map
 			["This", "is", "a", "test", "a", "b", "c"]
 		"""
-		op = operations.FlatMapOperation(self, map_func, context = context, **kwargs)
+		op = operations.FlatMapOperation(self, map_func, context = context, transport = transport, ordered = ordered, chunkseconds = chunkseconds, chunkbytes = chunkbytes, serializer = serializer, **kwargs)
+		return Dataset(op)
+
+	def filter(self, filter_func, context = None, **kwargs):
+		"""Returns a new `pyparade.Dataset` containing only the elements of this Dataset for which filter_func returns True.
+
+		Args:
+			filter_func: The function to be applied to each element. Has to accept an element from this Dataset as the first 
+					  argument and should return True if the element should be put into the output Dataset.
+			context: A function that returns a context manager. It is called once for each parallel executor 
+					 which executes filter_func. For each call of filter_func the context object is passed as the second argument.
+			**kwargs: Other arguments are passed on to `pyparade.operations.FilterOperation`
+
+		Example:
+			>>> import pyparade
+			>>> d = pyparade.Dataset([1,2,3,4])
+			>>> d.filter(lambda a: a % 2 == 0).collect() #keep even numbers
+			[2,4]
+		"""
+		op = operations.FilterOperation(self, filter_func, context = context, **kwargs)
 		return Dataset(op)
 
 	def batch(self, batch_size=1, **kwargs):
@@ -186,48 +437,77 @@ class Dataset(operations.Source):
 		op = operations.BatchOperation(self, batch_size=batch_size, **kwargs)
 		return Dataset(op)
 
-	def group_by_key(self, partly = False, **kwargs):
+	def group_by_key(self, partly = False, sort = False, num_partitions = None, memory_limit = None, **kwargs):
 		"""Returns a new `pyparade.Dataset` which results from grouping (key,value) tuples by their key into tuples (key, [values]).
+		Keys have to be hashable.
 
 		Args:
 			partly: If True, partial groups can be returned. This allows streaming processing with output 
 					starting before all elements in the dataset have been processed.
+			sort: If True, the groups are sorted by key (keys have to be comparable). By default, 
+				  groups are output in the order their keys first occur in this dataset.
+			num_partitions: If set, the pairs are divided into this number of partitions by the hash of their key and the 
+							partitions are grouped by the worker processes in parallel (for example 4 times the number of workers). 
+							Groups are then output in no particular order (unless sort is True) and the values of a group 
+							are not necessarily in the order of this dataset. hash_func=f changes how keys are hashed.
+			memory_limit: If set, groups whose estimated size exceeds memory_limit bytes are written to temporary files 
+						  in sorted runs, which are merged at the end. Keys have to be comparable and, if any runs were written, 
+						  the groups are output sorted by key.
 			**kwargs: Other arguments are passed on to `pyparade.operations.GroupByKeyOperation
 
 		Example:
 			>>> import pyparade
-			>>> d = pyparade.Dataset([("a", 1), ("b", 1), ("a",2)])
+			>>> d = pyparade.Dataset([("b", 1), ("a", 1), ("b",2)])
 			>>> d.group_by_key().collect()
-			[("a", [1,2]), ("b", [1])]
+			[("b", [1,2]), ("a", [1])]
+			>>> d.group_by_key(sort=True).collect()
+			[("a", [1]), ("b", [1,2])]
 
 		"""
-		op = operations.GroupByKeyOperation(self, partly = partly, **kwargs)
+		op = operations.GroupByKeyOperation(self, partly = partly, sort = sort, num_partitions = num_partitions, memory_limit = memory_limit, **kwargs)
 		return Dataset(op)
 
-	def reduce_by_key(self, reduce_func, **kwargs):
-		"""Returns a new `pyparade.Dataset` which results from grouping (key,value) tuples by their key into tuples (key, [values]) 
-		and applying reduce_func to each (key,[values]) tuple.
+	def reduce_by_key(self, reduce_func, sort = False, combine = True, **kwargs):
+		"""Returns a new `pyparade.Dataset` which results from grouping (key,value) tuples by their key 
+		and reducing the values of each key to one value using reduce_func. Keys have to be hashable.
 
 		Args:
-			reduce_func: The function to be applied to each (key,[values]) tuple. Has to accept a (key,[values]) tuple as the first 
-					  argument and should return a new element which is put into the output Dataset.
+			reduce_func: The function that combines two values of the same key, for example operator.add. 
+						 Has to accept two values as arguments and return the combined value.
+			sort: If True, the (key, value) tuples are sorted by key (keys have to be comparable). By default, 
+				  they are output in the order their keys first occur in this dataset.
+			combine: If True (default) and this dataset results from a map, flat_map or filter, the worker processes of that 
+					 operation already reduce the pairs of each batch by key, such that only partial results are sent back. 
+					 This requires reduce_func to be associative and picklable. The length of this dataset is not available then, 
+					 because it only receives the partial results.
 			**kwargs: Other arguments are passed on to `pyparade.operations.ReduceByKeyOperation`
+
+		Example:
+			>>> import pyparade, operator
+			>>> d = pyparade.Dataset([("b", 1), ("a", 1), ("b",2)])
+			>>> d.reduce_by_key(operator.add).collect()
+			[("b", 3), ("a", 1)]
 		"""
-		op = operations.ReduceByKeyOperation(self, reduce_func, **kwargs)
+		op = operations.ReduceByKeyOperation(self, reduce_func, sort = sort, combine = combine, **kwargs)
 		return Dataset(op)
 
-	def fold(self, zero_value, fold_func, context = None, **kwargs):
+	def fold(self, zero_value, fold_func, context = None, ordered = True, **kwargs):
 		"""Returns a new `pyparade.Dataset` containing one element which results by repeatedly applying the fold function.
+		The worker processes fold batches of elements into partial results, which are then folded together as well.
 
 		Supplying a context can be used to establish a connection to a common resource such as a database.
 
 		Args:
-			zero_value: An intial value that represents zero.
+			zero_value: An intial value that represents zero. Each partial result starts with a copy of it.
 			fold_func: The function to be used to fold two values. Must accept two values as arguments.
 					   Must return a new value that is again accepted as an argument to fold_func.
+					   Only fold_func and zero_value are sent to the worker processes.
 			context: A function that returns a context manager. It is called once for each parallel executor 
-					 which executes map_func. For each call of map_func the context object is passed as the second argument.
-			**kwargs: Other arguments are passed on to `pyparade.operations.FoldOperation`
+					 which executes fold_func. When the workers fold elements, the context object is passed to fold_func as the 
+					 third argument. Partial results are folded in this process without it, so the argument has to be optional.
+			ordered: If False, partial results are folded in the order they are calculated instead of the order of this Dataset.
+					 Only use this if fold_func is commutative.
+			**kwargs: Other arguments are passed on to `pyparade.operations.FoldOperation`, for example serializer="cloudpickle"
 
 		Example:
 			>>> import pyparade, operator
@@ -235,7 +515,37 @@ class Dataset(operations.Source):
 			>>> d.fold(0, operator.add).collect() #sum elements
 			[6]
 		"""
-		op = operations.FoldOperation(self, zero_value, fold_func, context = context, **kwargs)
+		op = operations.FoldOperation(self, zero_value, fold_func, context = context, ordered = ordered, **kwargs)
+		return Dataset(op)
+
+	def aggregate(self, zero_value, seq_func, comb_func, context = None, ordered = True, **kwargs):
+		"""Returns a new `pyparade.Dataset` containing one element which results from aggregating the elements of this Dataset. 
+		Unlike fold, the aggregated value can have a different type than the elements: the worker processes aggregate 
+		batches of elements into partial results using seq_func, which are then combined using comb_func.
+
+		Args:
+			zero_value: The initial value of each partial result. It has to be neutral for comb_func.
+			seq_func: The function that adds an element to a partial result. Has to accept a partial result and an element 
+					  (and the context object, if a context is given) and return the new partial result.
+			comb_func: The function that combines two partial results.
+			context: A function that returns a context manager. It is called once for each parallel executor 
+					 which executes seq_func. The context object is passed to seq_func as the third argument.
+			ordered: If False, partial results are combined in the order they are calculated instead of the order of this Dataset.
+					 Only use this if comb_func is commutative.
+			**kwargs: Other arguments are passed on to `pyparade.operations.FoldOperation`, for example serializer="cloudpickle"
+
+		Example:
+			>>> import pyparade
+			>>> def add(acc, value):
+			... 	return (acc[0] + value, acc[1] + 1)
+			>>> def combine(a, b):
+			... 	return (a[0] + b[0], a[1] + b[1])
+			>>> pyparade.Dataset([1,2,3,6]).aggregate((0, 0), add, combine).collect() #sum and count
+			[(12, 4)]
+		"""
+		if not "name" in kwargs:
+			kwargs["name"] = "Aggregate"
+		op = operations.FoldOperation(self, zero_value, seq_func, comb_func = comb_func, context = context, ordered = ordered, **kwargs)
 		return Dataset(op)
 
 	def start_process(self, name="Parallel Process", num_workers=multiprocessing.cpu_count(), **kwargs):
@@ -282,49 +592,100 @@ class Dataset(operations.Source):
 		Starts a `ParallelProcess` in order to collect the data.
 
 		Args:
-			**args: All arguments are passed on to `pyparade.Dataset.start_process` """
+			**args: All arguments are passed on to `pyparade.Dataset.start_process`, 
+					for example worker_pool to run all operations on a long-lived `pyparade.WorkerPool` """
+		return list(self.iterate(**args))
+
+	def iterate(self, **args):
+		"""A generator yielding the elements of this dataset as soon as they are calculated, 
+		such that the whole result does not need to fit into memory. Starts a `ParallelProcess` in order to calculate the data.
+		If the loop is left early (e.g. using break), the process is stopped.
+
+		Args:
+			**args: All arguments are passed on to `pyparade.Dataset.start_process`, 
+					for example worker_pool to run all operations on a long-lived `pyparade.WorkerPool`
+
+		Example:
+			>>> import pyparade
+			>>> d = pyparade.Dataset([1,2,3])
+			>>> for a in d.map(lambda a: a + 1).iterate(status=False):
+			...     print(a)
+			2
+			3
+			4
+		"""
 		global active_processes
 
 		old_handler = None
 		proc = None
-		if not self.running.is_set(): #no process running yet, start process
-			proc = self.start_process(**args)
-			active_processes.append(proc)
-			old_handler = signal.getsignal(signal.SIGINT)
-			signal.signal(signal.SIGINT, _signal_handler) #abort on CTRL-C
+		buf = self._get_buffer() #get buffer before starting the process, such that no output is missed
+		completed = False
+		try:
+			if not self.running.is_set(): #no process running yet, start process
+				proc = self.start_process(**args)
+				active_processes.append(proc)
+				old_handler = signal.getsignal(signal.SIGINT)
+				signal.signal(signal.SIGINT, _signal_handler) #abort on CTRL-C
+
+			if self._stop_requested.is_set():
+				self._stop_process(proc, old_handler)
 
-		if self._stop_requested.is_set():
-			self._stop_process(proc, old_handler)
+			for val in buf.generate():
+				if self._stop_requested.is_set():
+					self._stop_process(proc, old_handler)
+
+				yield val
 
-		result = []
-		for val in self._get_buffer().generate():
 			if self._stop_requested.is_set():
 				self._stop_process(proc, old_handler)
+			completed = True
+		finally:
+			self._remove_buffer(buf) #do not hold back the producer anymore
 
-			result.append(val)
+			if proc != None:
+				if not completed: #consumer stopped early or an error occurred, stop upstream operations
+					proc.stop()
+					proc.join()
 
-		if self._stop_requested.is_set():
-			self._stop_process(proc, old_handler)
+				if old_handler != None:
+					signal.signal(signal.SIGINT, old_handler)
+				else:
+					signal.signal(signal.SIGINT, signal.SIG_DFL)
+			
+			if proc in active_processes:
+				active_processes.remove(proc)
 
-		if old_handler != None:
-			signal.signal(signal.SIGINT, old_handler)
-		else:
-			signal.signal(signal.SIGINT, signal.SIG_DFL)
-		
-		if proc in active_processes:
-			active_processes.remove(proc)
+	def __iter__(self):
+		"""Iterates over the elements of this dataset while they are calculated (see `pyparade.Dataset.iterate`)"""
+		return self.iterate()
 
-		return result
+	def foreach(self, func, **args):
+		"""Calls func for each element of this dataset as soon as the element is calculated.
+
+		Args:
+			func: The function to be called. Has to accept an element of this Dataset as the only argument.
+			**args: All arguments are passed on to `pyparade.Dataset.start_process`"""
+		for val in self.iterate(**args):
+			func(val)
 
 class ParallelProcess(object):
 	"""A parallel process that collects data in a `pyparade.Dataset`"""
-	def __init__(self, dataset, name="Parallel process", status=True, status_interval=15):
+	def __init__(self, dataset, name="Parallel process", status=True, status_interval=15, worker_pool=None, fuse=True, flush_policy=None, memory_limit=None, buffer_bytes=None):
 		"""Creates a new parallel process
 		Args:
 			dataset: The `pyparade.Dataset` which the process should collect
 			name: The display name for the process
 			print_status: Display status information during processing?
 			print_status_interval: Update interval of status information in seconds
+			worker_pool: An optional `pyparade.WorkerPool` that is used by all operations of the process instead of 
+						 spawning new worker processes for each operation. The pool can be reused for several processes.
+			fuse: If True (default), consecutive map, flat_map and filter operations are executed together in one 
+				  parallel map, such that elements are only sent to the worker processes once
+			flush_policy: The flush policy of all datasets and operations of the process that do not set their own flush_policy,
+						  for example "low_latency" for interactive jobs or "high_throughput" for batch jobs (see `pyparade.FlushPolicy`)
+			memory_limit: The maximum estimated size in bytes of all elements in the buffers between the operations of the process (None for no limit). 
+						  Memory used inside of operations (e.g. by group_by_key) is not included.
+			buffer_bytes: The maximum estimated size in bytes of each buffer of datasets and operations that do not set their own limit (None for no limit)
 		"""
 
 		self.dataset = dataset
@@ -332,6 +693,12 @@ class ParallelProcess(object):
 		self.name = name
 		self.status = status
 		self.status_interval = status_interval
+		self.worker_pool = worker_pool
+		self.fuse = fuse
+		self.flush_policy = flush_policy
+		self.memory_limit = memory_limit
+		self.buffer_bytes = buffer_bytes
+		self.threads = []
 
 	def run(self, num_workers = multiprocessing.cpu_count()):
 		#Build process tree
@@ -339,26 +706,95 @@ class ParallelProcess(object):
 		chain.reverse()
 		self.chain = chain
 
+		memory_budget = MemoryBudget(self.memory_limit) if self.memory_limit != None else None
 		for source in self.chain:
 			source.processes.append(self)
+			source._stop_requested.clear() #an earlier process may have been stopped (and joined)
+			source.finished.clear() #the source may have run (or failed) before
+			source.exception = None
+			flush_policy = source.flush_policy if source.flush_policy != None else self.flush_policy
+			source._flush_policy = operations.get_flush_policy(flush_policy)
+
+			if isinstance(source, Dataset):
+				source._log.reset()
+				consumers = self._consumers(source)
+				for buf in list(source._buffers):
+					#the producer must not wait for operations that are not part of this process
+					source._log.set_active(buf, buf in consumers)
+
+			#limit the memory used by buffers
+			if isinstance(source, Dataset):
+				source._log.max_bytes = source.buffer_bytes if source.buffer_bytes != None else self.buffer_bytes
+				source._log.memory_budget = memory_budget
+			else:
+				source._max_outbuffer_bytes = source.outbuffer_bytes if source.outbuffer_bytes != None else self.buffer_bytes
+				source._memory_budget = memory_budget
+			if memory_budget != None: #wake up producers waiting for space when memory has been freed
+				memory_budget.add_listener(source._notify_space_freed)
+				if isinstance(source, Dataset):
+					memory_budget.add_listener(source._log.notify)
 
 		#set number of workers
 		for operation in [block for block in chain if isinstance(block, operations.Operation)]:
 			operation.num_workers = num_workers
+			operation.worker_pool = self.worker_pool
+			if isinstance(operation, operations.MapOperation): #forget the plan of an earlier process
+				operation.fuse(None)
+				operation.combine(None)
 
-		threads = []
-		for dataset in [block for block in chain if isinstance(block, Dataset)]:
+		fused_datasets = self.plan()
+
+		self.threads = []
+		for dataset in [block for block in chain if isinstance(block, Dataset) and not block in fused_datasets]:
 			t = threading.Thread(target = dataset._fill_buffers, name="Buffer")
 			t.start()
-			threads.append(t)
+			self.threads.append(t)
 
 		if self.status:
 			ts = threading.Thread(target = self.print_status)
 			ts.start()
 
+	def _consumers(self, dataset):
+		"""Returns the buffers of the dataset that are read in this process"""
+		return [buf for buf in dataset._buffers if buf.consumer == None or buf.consumer in self.chain]
+
+	def plan(self):
+		"""Fuses consecutive element-wise operations of the process (see `pyparade.operations.can_fuse`), if fuse is True, 
+		and lets element-wise operations followed by a reduce_by_key pre-reduce their output (see `pyparade.operations.can_combine`). 
+		Operations are not fused or combined if an intermediate dataset is also used by other operations or if it is cached.
+		Returns the intermediate datasets that are not filled anymore, because they are skipped by fused operations."""
+		fused_datasets = []
+		stages = []
+		for block in self.chain + [None]:
+			if isinstance(block, Dataset):
+				continue
+
+			exclusive = block != None and len(self._consumers(block.source)) == 1 and block.source._cache == None
+			if self.fuse and len(stages) > 0 and exclusive and operations.can_fuse(stages[-1], block):
+				stages.append(block)
+				continue
+
+			if len(stages) > 0 and exclusive and operations.can_combine(stages[-1], block):
+				stages[-1].combine(block.reduce_func)
+
+			if len(stages) > 1:
+				stages[-1].fuse(stages)
+				fused_datasets.extend(stage.source for stage in stages[1:])
+			stages = [block] if block != None else []
+		return fused_datasets
+
 	def stop(self):
 		[s.stop() for s in self.chain]
 
+	def join(self, timeout = None):
+		"""Waits until all datasets of the process have stopped filling their buffers and all operations have stopped running, 
+		for example after `pyparade.ParallelProcess.stop`"""
+		for t in self.threads:
+			t.join(timeout)
+		for operation in [block for block in self.chain if isinstance(block, operations.Operation)]:
+			if getattr(operation, "_thread", None) != None:
+				operation._thread.join(timeout)
+
 	def clear_screen(self):
 		"""Clear screen, return cursor to top left"""
 		sys.stdout.write('\033[2J')
@@ -398,8 +834,10 @@ class ParallelProcess(object):
 	def get_buffer_status(self, op):
 		status = ""
 
-		if not op.source.length_is_estimated():
+		if op.source.has_length() and not op.source.length_is_estimated():
 			status += str(len(op.source))
+		elif op.source.estimated_length() != None:
+			status += "~" + str(op.source.estimated_length())
 		elif not op.source.running.is_set():
 			status += "stopped"
 
@@ -418,16 +856,19 @@ class ParallelProcess(object):
 		elif op._check_stop():
 			status += "stopping"
 		else:
+			total = op.source.estimated_length()
 			if op.source.has_length():
-				if not op.source.length_is_estimated() and len(op.source) > 0 and op.processed > 0:
+				if total != None and total > 0 and op.processed > 0:
+					total = max(total, op.processed)
+					approx = "~" if op.source.length_is_estimated() else "" #marks estimated lengths
 					if op.finished.is_set():
 						status += "done"
 					elif op.output_finished.is_set():
 						status += "finishing"
 					elif op.running.is_set():
-						est = datetime.datetime.now() + datetime.timedelta(seconds = (time.time()-op.time_started)/op.processed*(len(op.source)-op.processed))
-						status += '{0:%}'.format(float(op.processed)/len(op.source)) + "  ETA " + est.strftime("%Y-%m-%d %H:%M") + " "
-						status += str(op.processed) + "/" + str(len(op.source))
+						est = datetime.datetime.now() + datetime.timedelta(seconds = (time.time()-op.time_started)/op.processed*(total-op.processed))
+						status += approx + '{0:%}'.format(float(op.processed)/total) + "  ETA " + est.strftime("%Y-%m-%d %H:%M") + " "
+						status += str(op.processed) + "/" + approx + str(total)
 					else:
 						status += "stopped"
 				else:
@@ -455,63 +896,304 @@ class ParallelProcess(object):
 	def __str__(self):
 		return self.name
 
+class DatasetCache(object):
+	"""Stores the batches of a `pyparade.Dataset` (see `pyparade.Dataset.cache`)"""
+	STORAGES = ["memory", "disk"]
+
+	def __init__(self, storage = "memory"):
+		"""Creates a new DatasetCache.
+
+		Args:
+			storage: "memory" keeps the batches in a list, "disk" pickles them into a temporary file"""
+		if not storage in self.STORAGES:
+			raise ValueError("Unknown cache storage: " + str(storage))
+		self.storage = storage
+		self.complete = False
+		self._batches = []
+		self._offsets = [] #positions of the batches in the file
+		self._file = None
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		"""The number of batches in the cache"""
+		return max(len(self._batches), len(self._offsets))
+
+	def append(self, batch):
+		"""Adds a batch to the end of the cache"""
+		if self.storage == "memory":
+			self._batches.append(batch)
+			return
+		with self._lock:
+			if self._file == None:
+				self._file = tempfile.TemporaryFile()
+			self._file.seek(0, os.SEEK_END)
+			self._offsets.append(self._file.tell())
+			pickle.dump(batch, self._file, pickle.HIGHEST_PROTOCOL)
+
+	def batches(self):
+		"""A generator yielding all batches in the cache. Several generators can read the cache at the same time."""
+		for i in range(0, len(self)):
+			if self.storage == "memory":
+				yield self._batches[i]
+			else:
+				with self._lock:
+					self._file.seek(self._offsets[i])
+					batch = pickle.load(self._file)
+				yield batch
+
+	def clear(self):
+		"""Drops all batches and deletes the temporary file"""
+		with self._lock:
+			self.complete = False
+			self._batches = []
+			self._offsets = []
+			if self._file != None:
+				self._file.close()
+				self._file = None
+
+class BroadcastBuffer(object):
+	"""A log of batches shared by all consumers of a `pyparade.operations.Source`. Each batch is put into the log once 
+	and every consumer reads it using its own `pyparade.Buffer`, which is a cursor into the log. 
+	Batches are dropped from the log as soon as all consumers have read them.
+
+	The producer has to wait while a consumer lags a full buffer size (or max_bytes) behind. To prevent a slow consumer from throttling 
+	the producer and all other consumers, a lagging consumer can spill up to spill_limit batches to a temporary file."""
+	def __init__(self, spill_limit = 0, max_bytes = None, memory_budget = None):
+		"""Creates a new BroadcastBuffer.
+
+		Args:
+			spill_limit: The maximum number of batches each consumer can spill to disk (0 disables spilling)
+			max_bytes: The maximum estimated size in bytes of the batches a consumer has not read yet (None for no limit)
+			memory_budget: A `pyparade.util.MemoryBudget` shared with other buffers. While it is exceeded, 
+						   the producer has to wait until the log is empty."""
+
+		super(BroadcastBuffer, self).__init__()
+		self.spill_limit = spill_limit
+		self.max_bytes = max_bytes
+		self.memory_budget = memory_budget
+		self._batches = collections.deque()
+		self._sizes = collections.deque() #estimated sizes of the batches in bytes
+		self._start = 0 #log position of the first batch in _batches
+		self._end = 0 #log position after the last batch
+		self._ended = False
+		self._consumers = []
+		self._condition = threading.Condition()
+
+	def add_consumer(self, buf):
+		"""Adds a `pyparade.Buffer` that reads all batches put into the log from now on"""
+		with self._condition:
+			buf._position = self._end
+			self._consumers.append(buf)
+
+	def set_active(self, buf, active):
+		"""Adds or removes a `pyparade.Buffer`, for example to not wait for consumers that are not part of the running process"""
+		if active and not buf in self._consumers:
+			self.add_consumer(buf)
+		elif not active and buf in self._consumers:
+			self.remove_consumer(buf)
+
+	def reset(self):
+		"""Prepares the log for being filled again, for example by another process"""
+		with self._condition:
+			self._ended = False
+
+	def remove_consumer(self, buf):
+		"""Removes a `pyparade.Buffer`, such that the producer does not wait for it anymore"""
+		with self._condition:
+			self._consumers.remove(buf)
+			buf._close_spill()
+			freed = self._trim()
+			self._condition.notify_all()
+		self._free(freed)
+
+	def full(self):
+		"""Returns True if any consumer lags a full buffer size behind and cannot spill anymore 
+		or if the memory budget is exceeded and the log is not empty"""
+		with self._condition:
+			return self._full()
+
+	def _full(self):
+		if self.memory_budget != None and len(self._batches) > 0 and self.memory_budget.exceeded():
+			return True
+		return len([buf for buf in self._consumers if buf._full()]) > 0
+
+	def _measures_bytes(self):
+		return self.max_bytes != None or self.memory_budget != None
+
+	def put(self, values):
+		"""Puts a batch of elements into the log. Blocks while the log is full.
+
+		Args:
+			values: A list containing the elements. The list is shared by all consumers and must not be changed afterwards."""
+
+		nbytes = util.estimate_size(values) if self._measures_bytes() else 0
+		with self._condition:
+			while self._full():
+				self._condition.wait(1) #the timeout is only a safeguard, memory freed by other buffers wakes up the producer
+			self._batches.append(values)
+			self._sizes.append(nbytes)
+			self._end += 1
+			if self.memory_budget != None:
+				self.memory_budget.allocate(nbytes)
+			for buf in self._consumers:
+				buf._length += len(values)
+				buf._bytes += nbytes
+				while buf._over_limit() and buf._spilled < self.spill_limit:
+					buf._spill(self._batches[buf._position - self._start])
+					buf._bytes -= self._sizes[buf._position - self._start]
+					buf._position += 1
+			freed = self._trim()
+			self._condition.notify_all()
+		self._free(freed)
+
+	def end(self):
+		"""Signals that no more batches will be put into the log"""
+		with self._condition:
+			self._ended = True
+			self._condition.notify_all()
+
+	def notify(self):
+		"""Wakes up a producer waiting for space, for example when memory has been freed by other buffers"""
+		with self._condition:
+			self._condition.notify_all()
+
+	def _get(self, buf):
+		"""Returns the next batch for the consumer buf or None if the end of the stream has been reached"""
+		freed = 0
+		with self._condition:
+			while buf._spilled == 0 and buf._position >= self._end and not self._ended:
+				self._condition.wait()
+
+			if buf._spilled > 0: #spilled batches are older than the batches in the log
+				batch = buf._unspill()
+			elif buf._position < self._end:
+				batch = self._batches[buf._position - self._start]
+				buf._bytes -= self._sizes[buf._position - self._start]
+				buf._position += 1
+				freed = self._trim()
+			else: #end of stream
+				return None
+
+			buf._length -= len(batch)
+			self._condition.notify_all()
+		self._free(freed)
+		return batch
+
+	def _trim(self):
+		"""Drops all batches that have been read by all consumers and returns their size in bytes"""
+		freed = 0
+		position = min([buf._position for buf in self._consumers] + [self._end])
+		while self._start < position:
+			self._batches.popleft()
+			freed += self._sizes.popleft()
+			self._start += 1
+		return freed
+
+	def _free(self, nbytes):
+		"""Returns memory to the memory budget. Must be called without holding the condition, because other buffers are notified."""
+		if self.memory_budget != None and nbytes > 0:
+			self.memory_budget.free(nbytes)
+
 class Buffer(object):
-	"""A thread-safe buffer used to read buffered from a `pyparade.operations.Source`"""
-	def __init__(self, source, size):
+	"""A thread-safe buffer used to read buffered from a `pyparade.operations.Source`. 
+	Elements are passed through the buffer in batches and all accounting is done per batch, 
+	the end of the stream is signalled separately using `pyparade.Buffer.end`. 
+	All buffers of a source read from one `pyparade.BroadcastBuffer`, such that batches are not copied for every consumer."""
+	def __init__(self, source, size, log = None, consumer = None):
 		"""Creates a new Buffer.
 
 		Args:
 			source: The `pyparade.operations.Source` which the buffer reads from
-			size: The size of the buffer (number of elements to keep in the buffer) """
+			size: The size of the buffer (number of batches to keep in the buffer)
+			log: The `pyparade.BroadcastBuffer` shared with the other consumers of the source (by default, the buffer has its own log)
+			consumer: The `pyparade.operations.Operation` reading from the buffer (None if the buffer is read directly, e.g. by `pyparade.Dataset.iterate`)"""
 
 		super(Buffer, self).__init__()
 		self.source = source
 		self.size = size
-		self.queue = queue.Queue(size)
+		self.consumer = consumer
+		self._log = log if log != None else BroadcastBuffer()
 		self._length = 0
-		self._length_lock = threading.Lock()
+		self._bytes = 0 #estimated size of the batches in the log that have not been read yet
+		self._position = 0 #position of the next batch to read in the log
+		self._spilled = 0 #number of batches in the spill file
+		self._spill_file = None
+		self._spill_read_pos = 0
+		self._log.add_consumer(self)
 
 	def __len__(self):
-		with self._length_lock:
-			return self._length
+		return self._length
 
 	def full(self):
-		"""Returns True if the buffer is full, that is the number of elements in the buffer is equal to the buffer size."""
-		return self.queue.full()
+		"""Returns True if the buffer is full, that is the number of batches (or bytes) in the buffer has reached its limit 
+		and no more batches can be spilled."""
+		with self._log._condition:
+			return self._full()
 
 	def put(self, values):
-		"""Puts a batch of elements into the buffer
-
-		Args:
-			values: An iterable containing the elements to but into the buffer. Must support calling len(values)."""
-
-		self.queue.put(values, True)
-
-		if not (len(values) > 0 and isinstance(values[-1], operations.OutputEndMarker)):
-			with self._length_lock:
-				self._length += len(values)
-		else:
-			with self._length_lock:
-				self._length += len(values)-1
+		"""Puts a batch of elements into the log of the buffer (see `pyparade.BroadcastBuffer.put`)"""
+		self._log.put(values)
+
+	def end(self):
+		"""Signals that no more batches will be put into the log of the buffer"""
+		self._log.end()
+
+	def batches(self):
+		"""A generator yielding the batches of elements in the buffer. Runs until the end of the stream is signalled 
+		and all batches have been read. Batches must not be changed by the consumer."""
+		while True:
+			batch = self._log._get(self)
+			if batch is None: #end of stream
+				break
+			self.source._notify_space_freed()
+			yield batch
+
+		self._raise_source_exception()
+
+	def _lag(self):
+		return self._log._end - self._position
+
+	def _over_limit(self):
+		"""Returns True if the unread batches in the log exceed the size or the byte limit of the buffer"""
+		if self._lag() >= self.size:
+			return True
+		return self._log.max_bytes != None and self._lag() > 0 and self._bytes >= self._log.max_bytes
+
+	def _full(self):
+		return self._over_limit() and self._spilled >= self._log.spill_limit
+
+	def _spill(self, batch):
+		if self._spill_file == None:
+			self._spill_file = tempfile.TemporaryFile()
+		self._spill_file.seek(0, os.SEEK_END)
+		pickle.dump(batch, self._spill_file, pickle.HIGHEST_PROTOCOL)
+		self._spilled += 1
+
+	def _unspill(self):
+		self._spill_file.seek(self._spill_read_pos)
+		batch = pickle.load(self._spill_file)
+		self._spill_read_pos = self._spill_file.tell()
+		self._spilled -= 1
+		if self._spilled == 0: #reuse the file from the beginning
+			self._spill_file.seek(0)
+			self._spill_file.truncate()
+			self._spill_read_pos = 0
+		return batch
+
+	def _close_spill(self):
+		if self._spill_file != None:
+			self._spill_file.close()
+			self._spill_file = None
+		self._spilled = 0
 
 	def generate(self):
 		"""A generator yielding elements from the buffer. Runs until the underlying `pyparade.operations.Source` is finished."""
+		for batch in self.batches():
+			for value in batch:
+				yield value
 
-		finished = False
-
-		while not finished or self.source._stop_requested.is_set():
-			try:
-				values = self.queue.get(True, timeout=1)
-				for value in values:
-					if not isinstance(value, operations.OutputEndMarker):
-						with self._length_lock:
-							self._length -= 1
-						yield value
-					else:
-						finished = True
-			except Exception as e:
-				pass
-
+	def _raise_source_exception(self):
+		"""Raises the exception of the first source in the chain that has failed and stops its processes"""
 		chain = [self.source] + self.source.get_parents()
 		chain.reverse()
 		
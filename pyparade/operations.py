@@ -3,22 +3,60 @@ standard_library.install_aliases()
 from builtins import str
 from builtins import zip
 from builtins import object
-import threading, multiprocessing, queue, time, collections, sys, traceback
+import threading, multiprocessing, queue, time, collections, sys, traceback, functools, math, os, pickle, tempfile, shutil, heapq, operator, copy
 
 import pyparade.util
 from pyparade.util import ParMap
-from pyparade.util.btree import BTree
+
+class FlushPolicy(object):
+	"""Decides when buffered output elements of a `pyparade.operations.Source` are passed on to the next operation. 
+	Small batches lower the latency of a pipeline, large batches lower the overhead per element."""
+	def __init__(self, max_delay = 0.5, max_size = None):
+		"""Args:
+			max_delay: Output is flushed when an element arrives and the last flush was at least max_delay seconds ago 
+					   (0 flushes every output immediately, None disables time-triggered flushes)
+			max_size: Output is flushed as soon as at least max_size elements are buffered (None disables size-triggered flushes).
+					  If both max_delay and max_size are None, output is only flushed when the source has finished."""
+		self.max_delay = max_delay
+		self.max_size = max_size
+
+	def should_flush(self, size, last_flush):
+		"""Returns True if size buffered elements should be flushed, last_flush is the time of the last flush"""
+		if self.max_size != None and size >= self.max_size:
+			return True
+		return self.max_delay != None and time.time() - last_flush >= self.max_delay
+
+FLUSH_POLICIES = {
+	"default": FlushPolicy(max_delay = 0.5),
+	"low_latency": FlushPolicy(max_delay = 0), #for interactive jobs
+	"high_throughput": FlushPolicy(max_delay = 5.0, max_size = 10000) #for batch jobs
+}
+
+def get_flush_policy(flush_policy):
+	"""Returns a `pyparade.operations.FlushPolicy`.
+	Args:
+		flush_policy: the name of a profile (see FLUSH_POLICIES), a FlushPolicy instance or None for the default policy"""
+	if flush_policy == None:
+		return FLUSH_POLICIES["default"]
+	if isinstance(flush_policy, FlushPolicy):
+		return flush_policy
+	if flush_policy in FLUSH_POLICIES:
+		return FLUSH_POLICIES[flush_policy]
+	raise ValueError("Unknown flush policy: " + str(flush_policy))
 
 class Source(object):
-	def __init__(self, name="Source", output_name=None):
+	def __init__(self, name="Source", output_name=None, flush_policy=None):
 		super(Source, self).__init__()
 		self._stop_requested = threading.Event()
+		self._space_freed = threading.Condition() #notified when a consumer takes elements out of a full buffer of this source
 		self.running = threading.Event()
 		self.finished = threading.Event()
 		self.name = name
 		self.output_name = output_name
 		self.processes = []
 		self.exception = None
+		self.flush_policy = flush_policy #set by the user, see `pyparade.operations.get_flush_policy`
+		self._flush_policy = get_flush_policy(flush_policy) #policy in effect, can be overridden by the process
 
 	def get_parents(self):
 		parents = [self]
@@ -38,6 +76,19 @@ class Source(object):
 	def stop(self):
 		if self.running.is_set():
 			self._stop_requested.set()
+			self._notify_space_freed() #wake up producers waiting for space
+
+	def _wait_for_space(self, is_full):
+		"""Blocks until is_full() returns False or a stop is requested. 
+		Producers are woken up by `pyparade.operations.Source._notify_space_freed` as soon as a consumer has taken elements."""
+		with self._space_freed:
+			while is_full() and not self._stop_requested.is_set():
+				self._space_freed.wait(1) #the timeout is only a safeguard, waiting producers are notified
+
+	def _notify_space_freed(self):
+		"""Wakes up all producers waiting for space in a buffer of this source"""
+		with self._space_freed:
+			self._space_freed.notify_all()
 
 	def __str__(self):
 		return self.name
@@ -46,24 +97,49 @@ class OutputEndMarker():
 	def __init__(self):
 		pass
 
+def _without_end_marker(batch):
+	"""Removes the `pyparade.operations.OutputEndMarker` from an output batch, which can only be its last element"""
+	if len(batch) > 0 and isinstance(batch[-1], OutputEndMarker):
+		return batch[:-1]
+	return batch
+
 class Operation(Source):
-	def __init__(self, source, num_workers=multiprocessing.cpu_count(), context = None, **kwargs):
+	def __init__(self, source, num_workers=multiprocessing.cpu_count(), context = None, outbuffer_bytes = None, **kwargs):
 		super(Operation, self).__init__(**kwargs)
 		self.source = source
-		self.inbuffer = source._get_buffer()
-		self._outbuffer = queue.Queue(10)
+		self.inbuffer = source._get_buffer(consumer = self)
+		self._outbuffer = queue.Queue(10) #output batches and their estimated sizes in bytes
+		self.outbuffer_bytes = outbuffer_bytes #set by the user
+		self._max_outbuffer_bytes = outbuffer_bytes #limit in effect, can be overridden by the process
+		self._outbuffer_bytes = 0
+		self._memory_budget = None
 		self._last_output = time.time()
 		self._outbatch = queue.Queue()
+		self._outbatch_size = 0
 		self.processed = 0
 		self.time_started = None
 		self.time_finished = None
 		self.num_workers = num_workers
 		self.context = context
+		self.worker_pool = None
 		self.output_finished = threading.Event()
+		self._run_finished = threading.Event()
+
+	def estimated_length(self):
+		"""Returns the estimated number of output elements or None if it cannot be estimated"""
+		return None
 
 	def __call__(self):
+		"""Runs the operation in a separate thread and yields batches of output elements"""
 		self.running.set()
 		self.time_started = time.time()
+		self.processed = 0
+		self.output_finished.clear() #the operation may have run before
+		self._run_finished.clear()
+		self._outbuffer = queue.Queue(10) #discard output that a stopped run has not passed on
+		self._outbuffer_bytes = 0
+		self._outbatch = queue.Queue()
+		self._outbatch_size = 0
 
 		def _run():
 			try:
@@ -74,6 +150,11 @@ class Operation(Source):
 				self.exception = error
 			finally:
 				self._outputs(OutputEndMarker())
+				self._run_finished.set()
+				try:
+					self._outbuffer.put_nowait(([], 0)) #wake up the consumer waiting for output
+				except queue.Full: #consumer is busy anyway
+					pass
 				if pyparade.util.DEBUG:
 					print(self.name + " has finished processing")
 
@@ -81,12 +162,10 @@ class Operation(Source):
 		self._thread = threading.Thread(target=_run, name=str(self))
 		self._thread.start()
 
-		#while processing, yield output batches
-		while self._thread.is_alive() and not self._check_stop():
+		#while processing, yield output batches (the end of the output is signalled by the end of the generator)
+		while not self._run_finished.is_set() and not self._check_stop():
 			try:
-				batch = self._outbuffer.get(True, timeout=1)
-				for value in batch:
-					yield value
+				yield self._get_output()
 			except queue.Empty:
 				pass
 
@@ -96,9 +175,7 @@ class Operation(Source):
 
 		while not self._outbuffer.empty() and not self._check_stop():
 			try:
-				batch = self._outbuffer.get(True, timeout=1)
-				for value in batch:
-					yield value
+				yield self._get_output()
 			except queue.Empty:
 				pass
 
@@ -114,9 +191,7 @@ class Operation(Source):
 			print(self.name + " is finishing output")
 		while not self._outbuffer.empty() and not self._check_stop():
 			try:
-				batch = self._outbuffer.get(True, timeout=1)
-				for value in batch:
-					yield value
+				yield self._get_output()
 			except queue.Empty:
 				pass
 
@@ -130,23 +205,50 @@ class Operation(Source):
 		if pyparade.util.DEBUG:
 			print(self.name + " is done")
 
+	def _get_output(self):
+		"""Takes the next batch out of the outbuffer and wakes up the operation if it is waiting for space"""
+		batch, nbytes = self._outbuffer.get(True, timeout=1)
+		with self._space_freed:
+			self._outbuffer_bytes -= nbytes
+			self._space_freed.notify_all()
+		if self._memory_budget != None and nbytes > 0:
+			self._memory_budget.free(nbytes)
+		return _without_end_marker(batch)
+
+	def _outbuffer_full(self):
+		"""Returns True if the outbuffer has reached its size or byte limit or if the memory budget of the process is exceeded"""
+		if self._outbuffer.full():
+			return True
+		if self._outbuffer.empty(): #an empty outbuffer always accepts a batch, such that the process keeps going
+			return False
+		if self._max_outbuffer_bytes != None and self._outbuffer_bytes >= self._max_outbuffer_bytes:
+			return True
+		return self._memory_budget != None and self._memory_budget.exceeded()
+
 	def _output(self, value):
 		self._outputs([value])
 
 	def _outputs(self, values):
 		self._outbatch.put(values)
-		if time.time() - self._last_output > 0.5:
+		if isinstance(values, OutputEndMarker):
+			return
+		self._outbatch_size += len(values)
+		if self._flush_policy.should_flush(self._outbatch_size, self._last_output):
 			self._flush_output()
 
 	def _flush_output(self, finish = False):
-		if self._outbuffer.full():
-			raise queue.Full("No space in outbuffer to flush output")
+		if self._outbuffer_full():
+			if finish:
+				raise queue.Full("No space in outbuffer to flush output")
+			return #keep collecting output in a larger batch while the consumer is busy
 
 		outbatch = []
+		self._outbatch_size = 0
 
 		while not self.output_finished.is_set() and not self._check_stop():
 			try:
-				batch_element = self._outbatch.get(timeout=1)
+				#only wait for the end marker when finishing, otherwise take the output available right now
+				batch_element = self._outbatch.get(finish, timeout=1)
 				if not isinstance(batch_element, OutputEndMarker):
 					outbatch.extend(batch_element)
 				else:
@@ -160,7 +262,14 @@ class Operation(Source):
 					break
 
 		if len(outbatch) > 0:
-			self._outbuffer.put(outbatch)
+			nbytes = 0
+			if self._max_outbuffer_bytes != None or self._memory_budget != None:
+				nbytes = pyparade.util.estimate_size(outbatch)
+				if self._memory_budget != None:
+					self._memory_budget.allocate(nbytes)
+			with self._space_freed:
+				self._outbuffer_bytes += nbytes
+			self._outbuffer.put((outbatch, nbytes))
 			self._last_output = time.time()
 
 
@@ -169,26 +278,255 @@ class Operation(Source):
 			self.time_finished = time.time()
 		return super(Operation, self)._check_stop()
 
-	def _generate_input(self):
-		for value in self.inbuffer.generate():
-			while self._outbuffer.full():
-				if self._check_stop():
-					raise BufferError("stop requested")
-				time.sleep(1)
-			yield value
+	def _generate_input(self, inbuffer = None):
+		if inbuffer == None:
+			inbuffer = self.inbuffer
+		for batch in inbuffer.batches():
+			for value in batch:
+				if self._outbuffer_full():
+					self._wait_for_space(self._outbuffer_full)
+					if self._check_stop():
+						raise BufferError("stop requested")
+				yield value
+
+	def _generate_input_batches(self, chunksize):
+		"""Yields the input elements in lists of chunksize elements"""
+		batch = []
+		for value in self._generate_input():
+			batch.append(value)
+
+			if len(batch) == chunksize:
+				yield batch
+				batch = []
+		if len(batch) > 0:
+			yield batch
+
+
+class _FusedFunction(object):
+	"""Applies the functions of several consecutive element-wise operations to an element. 
+	Returns the resulting elements and the number of elements processed by each operation."""
+	def __init__(self, stages):
+		"""Args:
+			stages: a list of (kind, function, uses_context) tuples, where kind is "map" or "flat_map" """
+		self.stages = stages
+
+	def __call__(self, value, contexts = None):
+		values = [value]
+		counts = []
+		for i, (kind, func, uses_context) in enumerate(self.stages):
+			counts.append(len(values))
+			args = (contexts[i],) if uses_context else ()
+			if kind == "map":
+				values = [func(v, *args) for v in values]
+			else:
+				values = [r for v in values for r in func(v, *args)]
+		return (values, counts)
+
+class _FusedContext(object):
+	"""Returns a context manager that enters the contexts of all fused operations and returns a list of the context objects"""
+	def __init__(self, context_funcs):
+		self.context_funcs = tuple(context_funcs)
+
+	def __call__(self):
+		return _FusedContextManager(self.context_funcs)
+
+	def __eq__(self, other): #allows workers of a pool to reuse the contexts between runs
+		return isinstance(other, _FusedContext) and self.context_funcs == other.context_funcs
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __hash__(self):
+		return hash(self.context_funcs)
+
+class _FusedContextManager(object):
+	def __init__(self, context_funcs):
+		self.context_funcs = context_funcs
+		self.context_managers = []
+
+	def __enter__(self):
+		contexts = []
+		for context_func in self.context_funcs:
+			if context_func != None:
+				context_manager = context_func()
+				contexts.append(context_manager.__enter__())
+				self.context_managers.append(context_manager)
+			else:
+				contexts.append(None)
+		return contexts
 
+	def __exit__(self, exc_type, exc_value, tb):
+		for context_manager in reversed(self.context_managers):
+			context_manager.__exit__(exc_type, exc_value, tb)
+
+class _CombineByKey(object):
+	"""Reduces the (key, value) pairs output by a `pyparade.operations._FusedFunction` for a batch by key. 
+	Returns one result containing the partial aggregates and the summed counts of processed elements."""
+	def __init__(self, reduce_func):
+		self.reduce_func = reduce_func
+
+	def __call__(self, results, *context):
+		if len(results) == 0:
+			return results
+
+		combined = {}
+		counts = [0] * len(results[0][1])
+		for values, value_counts in results:
+			counts = [a + b for a, b in zip(counts, value_counts)]
+			for k, v in values:
+				if k in combined:
+					combined[k] = self.reduce_func(combined[k], v)
+				else:
+					combined[k] = v
+		return [(list(combined.items()), counts)]
+
+def can_combine(first, second):
+	"""Returns True if the (key, value) pairs output by the element-wise operation first can be pre-reduced 
+	in the workers for the following `pyparade.operations.ReduceByKeyOperation` second (see `pyparade.operations.MapOperation.combine`)"""
+	if not isinstance(second, ReduceByKeyOperation) or not second.combine:
+		return False
+	if not type(first) in (MapOperation, FlatMapOperation, FilterOperation, ReadPartitionsOperation):
+		return False
+	if first.backend != "processes" or pyparade.util.is_coroutine_function(first.map_func):
+		return False
+	try: #the reduce function is sent to the workers with the map function
+		pyparade.util.get_serializer(first.serializer).dumps(second.reduce_func)
+	except Exception as e:
+		return False
+	return True
+
+def can_fuse(first, second):
+	"""Returns True if the element-wise operation second can be executed together with the preceding operation first 
+	in one parallel map (see `pyparade.operations.MapOperation.fuse`)"""
+	for op in (first, second):
+		if not type(op) in (MapOperation, FlatMapOperation, FilterOperation, ReadPartitionsOperation):
+			return False
+		if op.backend != "processes" or pyparade.util.is_coroutine_function(op.map_func):
+			return False
+	return first.transport == second.transport and first.serializer == second.serializer and first.worker_pool == second.worker_pool
 
 class MapOperation(Operation):
-	def __init__(self, source, map_func, num_workers = multiprocessing.cpu_count(), context = None, name = "Map", **kwargs):
+	fused_kind = "map"
+
+	def __init__(self, source, map_func, num_workers = multiprocessing.cpu_count(), context = None, name = "Map", transport = "pipe", ordered = True, prefetch = 1, backend = "processes", num_threads = None, concurrency = 100, chunkseconds = 3.0, chunkbytes = 16*1024*1024, serializer = "pickle", **kwargs):
+		"""An operation that applies map_func to each element of the source.
+
+		Args:
+			source: The `pyparade.Dataset`to use as the source of elements
+			map_func: The function to apply to each element
+			num_workers: The number of worker processes
+			context: A function that returns a context manager, which is entered once for each worker
+			name: The display name of the operation
+			transport: How elements are transferred to the workers ("pipe" or "shared_memory")
+			ordered: If False, results are output in the order they are calculated
+			prefetch: The number of batches queued at each worker in addition to the batch it is processing
+			backend: "processes" (default) or "threads" to run map_func in threads, which is suitable for I/O bound functions
+			num_threads: The number of threads used by the "threads" backend (default: 10 times num_workers)
+			concurrency: If map_func is a coroutine function (async def), the maximum number of calls running at the same time in each worker
+			chunkseconds: The targeted processing time of a batch sent to a worker in seconds
+			chunkbytes: The maximum size of a batch and its results in bytes (None for no limit)
+			serializer: How elements, results and map_func are serialized ("pickle", "pickle5", "cloudpickle" or "zlib"), see `pyparade.util.SERIALIZERS`
+			**kwargs: Other arguments are passed on to `pyparade.operations.Operation.__init__`
+		"""
 		super(MapOperation, self).__init__(source, num_workers, context, name = name, **kwargs)
 		self.map_func = map_func
+		self.transport = transport
+		self.ordered = ordered
+		self.prefetch = prefetch
+		self.backend = backend
+		self.num_threads = num_threads
+		self.concurrency = concurrency
+		self.chunkseconds = chunkseconds
+		self.chunkbytes = chunkbytes
+		self.serializer = serializer
+		self.fused_stages = None
+		self.combine_func = None
 		self.pool = None #multiprocessing.Pool(num_workers, maxtasksperchild = 1000, initializer = initializer)
 
+	def fuse(self, stages):
+		"""Lets this operation execute several consecutive element-wise operations in one parallel map, 
+		such that elements are only sent to the workers once. The other operations are not run on their own anymore, 
+		but their processed counters are still updated.
+
+		Args:
+			stages: The operations to fuse in the order they are applied, ending with this operation (None to run it on its own). 
+					See `pyparade.operations.can_fuse`
+		"""
+		self.fused_stages = stages
+
+	def combine(self, reduce_func):
+		"""Lets the workers pre-reduce the (key, value) pairs output for each batch by key using reduce_func, 
+		such that only one partial aggregate per key and batch is sent back. Used if this operation is followed 
+		by a `pyparade.operations.ReduceByKeyOperation` that reads all its output (see `pyparade.operations.can_combine`).
+
+		Args:
+			reduce_func: The reduce function of the following reduce_by_key (None to output all pairs)
+		"""
+		self.combine_func = reduce_func
+
+	def estimated_length(self):
+		if self.fused_kind == "map" and self.combine_func == None: #each element is mapped to exactly one result
+			return self.source.estimated_length()
+		return None
+
+	def _run_fused(self):
+		stages = self.fused_stages if self.fused_stages != None else [self]
+		started = time.time()
+		for stage in stages[:-1]: #the final operation has been reset when it was started
+			stage.running.set()
+			stage.time_started = started
+			stage.time_finished = None
+			stage.processed = 0
+		for stage in stages[1:]: #intermediate datasets
+			stage.source.running.set()
+
+		stage_funcs = [(stage.fused_kind, stage.map_func, stage.context != None) for stage in stages]
+		context_funcs = [stage.context for stage in stages]
+		if len([c for c in context_funcs if c != None]) > 0:
+			context = _FusedContext(context_funcs)
+		else:
+			context = None
+		ordered = len([stage for stage in stages if not stage.ordered]) == 0
+
+		combine_func = _CombineByKey(self.combine_func) if self.combine_func != None else None
+		self.pool = ParMap(_FusedFunction(stage_funcs), num_workers = self.num_workers, context_func = context, transport = self.transport, pool = self.worker_pool, ordered = ordered, prefetch = self.prefetch, chunkseconds = self.chunkseconds, chunkbytes = self.chunkbytes, serializer = self.serializer, combine_func = combine_func)
+		try:
+			for values, counts in self.pool.map(self._generate_input(stages[0].inbuffer), length_hint = stages[0].source.estimated_length):
+				if self._check_stop():
+					self.pool.stop()
+					return
+
+				for stage, count in zip(stages, counts):
+					stage.processed += count
+				for stage in stages[1:]:
+					stage.source._length = stage.processed
+				if len(values) > 0:
+					self._outputs(values)
+		finally:
+			finished = time.time()
+			for stage in stages[:-1]:
+				stage.time_finished = finished
+				stage.finished.set()
+				stage.running.clear()
+			for stage in stages[1:]:
+				stage.source._length_is_estimated = False
+				stage.source.finished.set()
+				stage.source.running.clear()
+
+	def _create_parmap(self):
+		if self.backend == "threads": #threads do not use the worker pool of the process
+			num_threads = self.num_threads if self.num_threads != None else 10*self.num_workers
+			return ParMap(self.map_func, num_workers = num_threads, context_func = self.context, ordered = self.ordered, prefetch = self.prefetch, backend = self.backend, concurrency = self.concurrency, chunkseconds = self.chunkseconds, chunkbytes = self.chunkbytes, serializer = self.serializer)
+		return ParMap(self.map_func, num_workers = self.num_workers, context_func = self.context, transport = self.transport, pool = self.worker_pool, ordered = self.ordered, prefetch = self.prefetch, backend = self.backend, concurrency = self.concurrency, chunkseconds = self.chunkseconds, chunkbytes = self.chunkbytes, serializer = self.serializer)
+
 	def run(self):
-		self.pool = ParMap(self.map_func, num_workers = self.num_workers, context_func = self.context)
+		if self.fused_stages != None or self.combine_func != None:
+			return self._run_fused()
+
+		self.pool = self._create_parmap()
 		#map
 		result = []
-		for response in self.pool.map(self._generate_input()):
+		for response in self.pool.map(self._generate_input(), length_hint = self.source.estimated_length):
 			if self._check_stop():
 				self.pool.stop()
 				return
@@ -198,14 +536,19 @@ class MapOperation(Operation):
 
 class FlatMapOperation(MapOperation):
 	"""Calls the map function for every value in the dataset and then flattens the result"""
+	fused_kind = "flat_map"
+
 	def __init__(self, source, map_func, num_workers=multiprocessing.cpu_count(), context = None, name = "FlatMap", **kwargs):
 		super(FlatMapOperation, self).__init__(source, map_func, num_workers, context, name = name, **kwargs)
 
 	def run(self):
-		self.pool = ParMap(self.map_func, num_workers = self.num_workers, context_func = self.context)
+		if self.fused_stages != None or self.combine_func != None:
+			return self._run_fused()
+
+		self.pool = self._create_parmap()
 		#map
 		result = []
-		for response in self.pool.map(self._generate_input()):
+		for response in self.pool.map(self._generate_input(), length_hint = self.source.estimated_length):
 			if self._check_stop():
 				self.pool.stop()
 				return
@@ -215,6 +558,42 @@ class FlatMapOperation(MapOperation):
 			for r in response: 
 				self._output(r)
 
+class _FilterFunction(object):
+	"""Returns a list containing the element if it passes the filter function, otherwise an empty list"""
+	def __init__(self, filter_func):
+		self.filter_func = filter_func
+
+	def __call__(self, value, *context):
+		if self.filter_func(value, *context):
+			return [value]
+		return []
+
+class FilterOperation(FlatMapOperation):
+	"""Keeps only the elements for which the filter function returns True"""
+	def __init__(self, source, filter_func, num_workers=multiprocessing.cpu_count(), context = None, name = "Filter", **kwargs):
+		if pyparade.util.is_coroutine_function(filter_func):
+			raise ValueError("Coroutine functions are not supported by filter")
+		super(FilterOperation, self).__init__(source, _FilterFunction(filter_func), num_workers, context, name = name, **kwargs)
+		self.filter_func = filter_func
+
+class _PartitionReader(object):
+	"""Reads all elements of a partition in the worker, such that generators can be used as reader functions"""
+	def __init__(self, reader_func):
+		self.reader_func = reader_func
+
+	def __call__(self, partition, *context):
+		return list(self.reader_func(partition, *context))
+
+class ReadPartitionsOperation(FlatMapOperation):
+	"""Reads the partitions of a source in the workers, the source only contains descriptions of the partitions (like file names or ranges of ids)"""
+	def __init__(self, source, reader_func, num_workers=multiprocessing.cpu_count(), context = None, name = "ReadPartitions", **kwargs):
+		if pyparade.util.is_coroutine_function(reader_func): #coroutines have to return lists, they cannot be wrapped
+			map_func = reader_func
+		else:
+			map_func = _PartitionReader(reader_func)
+		super(ReadPartitionsOperation, self).__init__(source, map_func, num_workers, context, name = name, **kwargs)
+		self.reader_func = reader_func
+
 class BatchOperation(Operation):
 	def __init__(self, source, batch_size, name = "Batch", **kwargs):
 		"""An operation that returns the elements of the source in batches of n elements.
@@ -230,6 +609,12 @@ class BatchOperation(Operation):
 		else:
 			raise ValueError("Illegal batch size")
 
+	def estimated_length(self):
+		length = self.source.estimated_length()
+		if length == None:
+			return None
+		return int(math.ceil(float(length)/self.batch_size))
+
 	def run(self):
 		#pack batches
 		n = 0
@@ -252,14 +637,126 @@ class BatchOperation(Operation):
 			self._output(batch)
 
 		
+class _PartitionWriter(object):
+	"""Appends the (key, value) pairs of a batch to the files of their partitions. Each worker process (and thread) 
+	writes its own files, such that workers do not need to synchronize. Returns the number of pairs written."""
+	def __init__(self, directory, num_partitions, hash_func):
+		self.directory = directory
+		self.num_partitions = num_partitions
+		self.hash_func = hash_func
+
+	def __call__(self, batch):
+		partitions = {}
+		for k, v in batch:
+			partition = self.hash_func(k) % self.num_partitions
+			if partition in partitions:
+				partitions[partition].append((k, v))
+			else:
+				partitions[partition] = [(k, v)]
+
+		writer = "%d-%d" % (os.getpid(), threading.current_thread().ident)
+		for partition, pairs in partitions.items():
+			with open(os.path.join(self.directory, "%d.%s" % (partition, writer)), "ab") as f:
+				pickle.dump(pairs, f, pickle.HIGHEST_PROTOCOL)
+		return len(batch)
+
+def _group_partition(partition, directory, sort):
+	"""Groups the (key, value) pairs written to the files of a partition by `pyparade.operations._PartitionWriter`"""
+	groups = {}
+	prefix = "%d." % partition
+	for filename in os.listdir(directory):
+		if not filename.startswith(prefix):
+			continue
+		with open(os.path.join(directory, filename), "rb") as f:
+			while True:
+				try:
+					pairs = pickle.load(f)
+				except EOFError:
+					break
+				for k, v in pairs:
+					if k in groups:
+						groups[k].append(v)
+					else:
+						groups[k] = [v]
+
+	keys = sorted(groups) if sort else groups
+	return [(k, groups[k]) for k in keys]
+
+def _write_run(groups, directory, block_size = 1000):
+	"""Writes the groups sorted by key to a new file in directory as a sequence of pickled blocks of (key, values) tuples. 
+	Returns the path of the file."""
+	fd, path = tempfile.mkstemp(prefix = "run-", dir = directory)
+	with os.fdopen(fd, "wb") as f:
+		block = []
+		for k in sorted(groups):
+			block.append((k, groups[k]))
+			if len(block) >= block_size:
+				pickle.dump(block, f, pickle.HIGHEST_PROTOCOL)
+				block = []
+		if len(block) > 0:
+			pickle.dump(block, f, pickle.HIGHEST_PROTOCOL)
+	return path
+
+def _read_run(path):
+	"""Yields the (key, values) tuples of a file written by `pyparade.operations._write_run`"""
+	with open(path, "rb") as f:
+		while True:
+			try:
+				block = pickle.load(f)
+			except EOFError:
+				return
+			for group in block:
+				yield group
+
+def _merge_runs(paths):
+	"""Merges the sorted runs and yields each key with the values of all runs in the order the runs were written"""
+	key = None
+	values = None
+	for k, v in heapq.merge(*[_read_run(path) for path in paths], key = operator.itemgetter(0)): #equal keys are merged in the order of the runs
+		if values != None and k == key:
+			values.extend(v)
+			continue
+		if values != None:
+			yield (key, values)
+		key = k
+		values = v
+	if values != None:
+		yield (key, values)
+
 class GroupByKeyOperation(Operation):
 	"""Groups the key/value pairs and yields tuples (key, [list of values])"""
-	def __init__(self, source, partly = False, num_workers=multiprocessing.cpu_count(), name = "GroupByKey", **kwargs):
+	def __init__(self, source, partly = False, sort = False, num_partitions = None, hash_func = pyparade.util.stable_hash, memory_limit = None, num_workers=multiprocessing.cpu_count(), name = "GroupByKey", **kwargs):
+		"""Args:
+			source: The `pyparade.Dataset` of (key, value) tuples to group
+			partly: If True, groups are output periodically while the input is read, so a key can occur in several groups
+			sort: If True, groups are output sorted by key. Otherwise they are output in the order their keys first occurred.
+			num_partitions: If set, the pairs are divided into this number of partitions by the hash of their key, 
+							which are grouped by the worker processes in parallel (see `pyparade.operations.GroupByKeyOperation.run_partitioned`)
+			hash_func: The function used to assign keys to partitions, has to return the same hash for a key in all processes
+			memory_limit: If set, the groups are written to temporary files in sorted runs whenever their estimated size exceeds 
+						  memory_limit bytes, and the runs are merged at the end (see `pyparade.operations.GroupByKeyOperation.run_external`). 
+						  Groups are output sorted by key if any runs were written.
+			**kwargs: Other arguments are passed on to `pyparade.operations.Operation.__init__`
+		"""
 		super(GroupByKeyOperation, self).__init__(source, num_workers, name = name, **kwargs)
+		if partly and num_partitions != None:
+			raise ValueError("Partial groups cannot be output when grouping in partitions")
+		if memory_limit != None and (partly or num_partitions != None):
+			raise ValueError("A memory limit can only be set when grouping completely in this process")
 		self.partly = partly
+		self.sort = sort
+		self.num_partitions = num_partitions
+		self.hash_func = hash_func
+		self.memory_limit = memory_limit
+		self.pool = None
+
+	def _output_groups(self, groups):
+		keys = sorted(groups) if self.sort else groups
+		for k in keys:
+			self._output((k, groups[k]))
 
 	def run_partly(self, chunksize):
-		tree = BTree(chunksize, None, None)
+		groups = {}
 
 		items_since_last_group = 0
 		last_key = None
@@ -267,112 +764,222 @@ class GroupByKeyOperation(Operation):
 			if self._check_stop():
 				return
 
-			if k in tree:
-				tree[k].append(v)
+			if k in groups:
+				groups[k].append(v)
 			else:
-				tree[k] = [v]
+				groups[k] = [v]
 			self.processed += 1
 			items_since_last_group += 1
 
 			if items_since_last_group >= (chunksize*self.num_workers) and k != last_key: #only output elements periodically and once key changes
-				keyleafs = [l for l in tree.get_leafs()]
-				for key, leaf in keyleafs:
-					for k, v in zip(leaf.keys, leaf.values):
-						self._output((k,v))
-				tree = BTree(chunksize, None, None)
+				self._output_groups(groups)
+				groups = {}
 				items_since_last_group = 0
 
 			last_key = k
 
-		keyleafs = [l for l in tree.get_leafs()]
-		for key, leaf in keyleafs:
-			for k, v in zip(leaf.keys, leaf.values):
-				self._output((k,v))
+		self._output_groups(groups)
+
+	def run_partitioned(self, batch_size = 10000):
+		"""Groups in two parallel phases: the workers write the pairs to temporary files, one per partition (and worker), 
+		then each partition is grouped by a worker and its groups are output. The values of a group are not necessarily 
+		in the order of the input. Sorted output is merged from the sorted partitions."""
+		directory = tempfile.mkdtemp(prefix = "pyparade-")
+		try:
+			self.pool = ParMap(_PartitionWriter(directory, self.num_partitions, self.hash_func), num_workers = self.num_workers, pool = self.worker_pool)
+			for written in self.pool.map(self._generate_input_batches(batch_size)):
+				if self._check_stop():
+					self.pool.stop()
+					return
+				self.processed += written
+
+			group_partition = functools.partial(_group_partition, directory = directory, sort = self.sort)
+			self.pool = ParMap(group_partition, num_workers = self.num_workers, pool = self.worker_pool, ordered = False)
+			partitions = []
+			for groups in self.pool.map(range(0, self.num_partitions)):
+				if self._check_stop():
+					self.pool.stop()
+					return
+				if self.sort: #wait for all partitions
+					partitions.append(groups)
+				else:
+					for group in groups:
+						self._output(group)
+
+			for group in heapq.merge(*partitions, key = operator.itemgetter(0)):
+				self._output(group)
+		finally:
+			shutil.rmtree(directory, ignore_errors = True)
+
+	def run_external(self, sample_size = 1000):
+		"""Groups in memory until the estimated size of the groups exceeds the memory limit, then writes them 
+		to a temporary file sorted by key (a run) and continues with empty groups. At the end, the runs are merged, 
+		such that the groups are output sorted by key and the values of a group are in the order of the input."""
+		directory = tempfile.mkdtemp(prefix = "pyparade-")
+		try:
+			groups = {}
+			runs = []
+			used = 0
+			sample = []
+			for k, v in self._generate_input():
+				if self._check_stop():
+					return
+
+				if k in groups:
+					groups[k].append(v)
+				else:
+					groups[k] = [v]
+				self.processed += 1
+
+				sample.append((k, v))
+				if len(sample) >= sample_size: #estimating the size of every pair would be too slow
+					used += pyparade.util.estimate_size(sample)
+					sample = []
+					if used > self.memory_limit:
+						runs.append(_write_run(groups, directory))
+						groups = {}
+						used = 0
+
+			if len(runs) == 0:
+				self._output_groups(groups)
+				return
+
+			runs.append(_write_run(groups, directory))
+			groups = None
+			for group in _merge_runs(runs):
+				if self._check_stop():
+					return
+				self._output(group)
+		finally:
+			shutil.rmtree(directory, ignore_errors = True)
 
 	def run(self, chunksize=10):
 		if self.partly:
 			return self.run_partly(chunksize)
+		if self.num_partitions != None:
+			return self.run_partitioned()
+		if self.memory_limit != None:
+			return self.run_external()
 
-		tree = BTree(chunksize, None, None)
+		groups = {}
 
 		for k, v in self._generate_input():
 			if self._check_stop():
 				return
 
-			if k in tree:
-				tree[k].append(v)
+			if k in groups:
+				groups[k].append(v)
 			else:
-				tree[k] = [v]
+				groups[k] = [v]
 			self.processed += 1
 
-		keyleafs = [l for l in tree.get_leafs()]
-		for key, leaf in keyleafs:
-			for k, v in zip(leaf.keys, leaf.values):
-				self._output((k,v))
+		self._output_groups(groups)
 
 class ReduceByKeyOperation(Operation):
 	"""Reduces the dataset by grouping the key/value pairs by key and applying the reduce_func to the values of each group"""
-	def __init__(self, source, reduce_func, num_workers=multiprocessing.cpu_count(), name = "ReduceByKey", **kwargs):
+	def __init__(self, source, reduce_func, sort = False, combine = True, num_workers=multiprocessing.cpu_count(), name = "ReduceByKey", **kwargs):
+		"""Args:
+			source: The `pyparade.Dataset` of (key, value) tuples to reduce
+			reduce_func: A function that combines two values of the same key into one
+			sort: If True, the results are output sorted by key. Otherwise they are output in the order their keys first occurred.
+			combine: If True (default) and the source results from a map, flat_map or filter, the workers of that operation 
+					 already reduce the pairs of each batch, such that fewer pairs are sent back. reduce_func has to be associative.
+			**kwargs: Other arguments are passed on to `pyparade.operations.Operation.__init__`
+		"""
 		super(ReduceByKeyOperation, self).__init__(source, num_workers, name = name, **kwargs)
 		self.reduce_func = reduce_func
+		self.sort = sort
+		self.combine = combine
 
-	def run(self, chunksize=10):
-		tree = BTree(chunksize, None, None)
+	def run(self):
+		results = {}
 
 		for k, v in self._generate_input():
 			if self._check_stop():
 				return
 
-			if k in tree:
-				tree[k] = self.reduce_func(tree[k], v)
+			if k in results:
+				results[k] = self.reduce_func(results[k], v)
 			else:
-				tree[k] = v
+				results[k] = v
 			self.processed += 1
 
-		keyleafs = [l for l in tree.get_leafs()]
-		for key, leaf in keyleafs:
-			for k, v in zip(leaf.keys, leaf.values):
-				self._output((k,v))
+		keys = sorted(results) if self.sort else results
+		for k in keys:
+			self._output((k, results[k]))
 
-class FoldOperation(Operation):
-	"""Folds the dataset using a combine function"""
-	def __init__(self, source, zero_value, fold_func, num_workers=multiprocessing.cpu_count(), context = None, name = "Fold", **kwargs):
-		super(FoldOperation, self).__init__(source, num_workers, context, name = name, **kwargs)
-		self.pool = None #ParMap(self._fold_batch, num_workers = num_workers) #futures.ThreadPoolExecutor(num_workers)
+_EMPTY = object() #marks missing partial results, which cannot be None as None can be a result
+
+def _identity(value, *context):
+	return value
+
+class _FoldResults(object):
+	"""Folds the elements of a batch into a partial result in the worker, starting with a copy of the zero value. 
+	Only this object is sent to the workers, not the `pyparade.operations.FoldOperation`. 
+	Returns one result containing the partial result and the number of elements folded."""
+	def __init__(self, zero_value, fold_func):
 		self.zero_value = zero_value
 		self.fold_func = fold_func
 
-	def _generate_input_batches(self, chunksize):
-		batch = []
-		for value in self._generate_input():
-			batch.append(value)
+	def __call__(self, values, *context):
+		result = copy.deepcopy(self.zero_value) #fold_func may modify the zero value
+		for value in values:
+			result = self.fold_func(result, value, *context)
+		return [(result, len(values))]
 
-			if len(batch) == chunksize:
-				yield batch
-				batch = []
-		yield batch
+class FoldOperation(Operation):
+	"""Folds the dataset using a fold function. The workers fold the elements of each batch into a partial result, 
+	the partial results are combined in a tree, such that the number of pending partial results stays small."""
+	def __init__(self, source, zero_value, fold_func, comb_func = None, num_workers=multiprocessing.cpu_count(), context = None, name = "Fold", ordered = True, prefetch = 1, serializer = "pickle", chunkseconds = 3.0, **kwargs):
+		"""Args:
+			source: The `pyparade.Dataset` to fold
+			zero_value: The initial value of each partial result, has to be neutral for comb_func
+			fold_func: A function that folds an element into a partial result, called with the partial result, 
+					   the element and (if there is a context) the context object
+			comb_func: A function that combines two partial results (defaults to fold_func, called without the context object)
+			ordered: If False, partial results are combined in the order they are calculated
+			chunkseconds: The targeted processing time of a batch sent to a worker in seconds, 
+						  each batch results in one partial result
+			**kwargs: Other arguments are passed on to `pyparade.operations.Operation.__init__`
+		"""
+		super(FoldOperation, self).__init__(source, num_workers, context, name = name, **kwargs)
+		self.ordered = ordered
+		self.prefetch = prefetch
+		self.serializer = serializer
+		self.chunkseconds = chunkseconds
+		self.pool = None
+		self.zero_value = zero_value
+		self.fold_func = fold_func
+		self.comb_func = comb_func if comb_func != None else fold_func
 
-	def _fold_batch(self, batch):
-		result = self.zero_value
-		for value in batch:
-			result = self.fold_func(result, value)
-		return result
+	def estimated_length(self):
+		return 1
 
-	def run(self, chunksize = 10):
-		self.pool = ParMap(self._fold_batch, num_workers = self.num_workers, context_func = self.context)
-		result = []
+	def run(self):
+		self.pool = ParMap(_identity, num_workers = self.num_workers, context_func = self.context, pool = self.worker_pool, ordered = self.ordered, prefetch = self.prefetch, 
+			serializer = self.serializer, chunkseconds = self.chunkseconds, combine_func = _FoldResults(self.zero_value, self.fold_func))
 
-		for response in self.pool.map(self._generate_input_batches(chunksize = chunksize)):
+		#levels[i] is empty or the combination of 2^i partial results, earlier levels contain later results
+		levels = []
+		for partial, count in self.pool.map(self._generate_input(), length_hint = self.source.estimated_length):
 			if self._check_stop():
 				self.pool.stop()
 				return
 
-			result.append(response)
-
-			if len(result) == chunksize:
-				result = [self._fold_batch(result)]
+			self.processed += count
+			i = 0
+			while i < len(levels) and levels[i] is not _EMPTY:
+				partial = self.comb_func(levels[i], partial)
+				levels[i] = _EMPTY
+				i += 1
+			if i == len(levels):
+				levels.append(partial)
+			else:
+				levels[i] = partial
 
-			self.processed += 1
-		
-		self._output(self._fold_batch(result))
+		result = _EMPTY
+		for partial in reversed(levels):
+			if partial is not _EMPTY:
+				result = partial if result is _EMPTY else self.comb_func(result, partial)
+		self._output(result if result is not _EMPTY else copy.deepcopy(self.zero_value))
 
@@ -1,7 +1,7 @@
 # coding=utf-8
 from __future__ import print_function
 import unittest, re, operator
-import time, random
+import time, random, asyncio, threading, tempfile, struct, os
 
 
 import pyparade
@@ -9,6 +9,43 @@ import pyparade.util
 
 #pyparade.util.DEBUG = True
 
+def add_one(a):
+	return a + 1
+
+def word_pairs(line):
+	return [(word, 1) for word in line.split(" ")]
+
+def read_range(r):
+	for i in range(r[0], r[1]):
+		yield i
+
+def add_one_slowly(a):
+	time.sleep(0.0005)
+	return a + 1
+
+def add_to_mean(acc, value):
+	return (acc[0] + value, acc[1] + 1)
+
+def combine_means(a, b):
+	return (a[0] + b[0], a[1] + b[1])
+
+def add_slowly_to_mean(acc, value):
+	time.sleep(0.001)
+	return (acc[0] + value, acc[1] + 1, acc[2])
+
+def combine_batch_means(a, b):
+	return (a[0] + b[0], a[1] + b[1], a[2] + b[2])
+
+def append(values, value):
+	values.append(value)
+	return values
+
+async def add_one_later(a):
+	await asyncio.sleep(0.01)
+	if a < 0:
+		raise ValueError(a)
+	return a + 1
+
 class TestPyParade(unittest.TestCase):
 	"""Uses a comination of map and reduceByKey to calculate occurencies of each word in a text.
 	"""
@@ -55,7 +92,7 @@ class TestPyParade(unittest.TestCase):
 			k,values = a
 			return (k, sum(values)/len(values))
 
-		result = d.map(f).group_by_key().map(g).collect()
+		result = d.map(f).group_by_key(sort=True).map(g).collect()
 
 		for i in range(0,10):
 			self.assertEqual(result[i][0], i)
@@ -102,6 +139,48 @@ class TestPyParade(unittest.TestCase):
 		equal = [i+1 for i in range(0,15)]
 		self.assertEqual(sum(equal), sum(inc))
 
+	def test_unordered_map(self):
+		d = pyparade.Dataset(list(range(0,1000)), name="Numbers")
+		result = d.map(add_one, ordered=False).flat_map(lambda a: [a, a], ordered=False).fold(0, operator.add, ordered=False).collect(status=False)
+		self.assertEqual(result[0], 2*sum(range(1,1001)))
+
+	def test_threads(self):
+		def f(a):
+			time.sleep(0.01)
+			return a + 1
+
+		d = pyparade.Dataset(list(range(0,1000)), name="Numbers")
+		result = d.map(f, backend="threads", num_threads=50).collect(status=False)
+		self.assertEqual(result, list(range(1,1001)))
+
+	def test_async_map(self):
+		d = pyparade.Dataset(list(range(0,1000)), name="Numbers")
+		result = d.map(add_one_later, concurrency=20).collect(status=False)
+		self.assertEqual(result, list(range(1,1001)))
+
+		d = pyparade.Dataset([1,2,-3,4], name="Numbers")
+		self.assertRaises(ValueError, d.map(add_one_later).collect, status=False)
+
+	def test_fusion(self):
+		d = pyparade.Dataset(list(range(0,1000)), name="Numbers")
+		incremented = d.map(lambda a: a + 1)
+		even = incremented.filter(lambda a: a % 2 == 0)
+		pairs = even.flat_map(lambda a: [a, -a])
+		result = pairs.collect(status=False)
+
+		self.assertEqual(result, [v for a in range(2,1001,2) for v in (a, -a)])
+		self.assertEqual(3, len(pairs.source.fused_stages))
+		#each fused operation still counts the elements it processed
+		self.assertEqual(1000, incremented.source.processed)
+		self.assertEqual(1000, even.source.processed)
+		self.assertEqual(500, pairs.source.processed)
+		self.assertEqual(500, len(even))
+
+		self.assertEqual(result, pairs.collect(status=False))
+		self.assertEqual(1000, incremented.source.processed) #counts start again when the fused operations are run again
+		self.assertEqual(1000, even.source.processed)
+		self.assertEqual(500, pairs.source.processed)
+
 	def test_batch(self):
 		d = pyparade.Dataset(list(range(0,1000)), name="Numbers")
 
@@ -121,3 +200,254 @@ class TestPyParade(unittest.TestCase):
 		d = pyparade.Dataset([1,2,3,4,5,6,7,8,9], name="Number")
 
 		self.assertRaises(ValueError, d.map(throw_error).collect)
+
+	def test_rerun_after_error(self):
+		values = [1, 2, "three", 4]
+		d = pyparade.Dataset(values, name="Numbers").map(add_one)
+		self.assertRaises(TypeError, d.collect, status=False)
+		values[2] = 3 #fix the cause of the error
+		self.assertEqual([2, 3, 4, 5], d.collect(status=False))
+
+		d = pyparade.Dataset(list(range(0,1000)), name="Numbers").map(add_one_slowly)
+		d.collect(status=False)
+		proc = d.start_process(status=False)
+		self.assertFalse(d.source.finished.is_set()) #the status of a new process does not show earlier runs as finished
+		proc.join()
+		self.assertTrue(d.source.finished.is_set())
+
+	def test_source_error(self):
+		def numbers():
+			yield 1
+			raise ValueError("source failed")
+
+		self.assertRaises(ValueError, pyparade.Dataset(numbers(), name="Numbers").collect, status=False)
+
+	def test_worker_pool(self):
+		with pyparade.WorkerPool(2) as pool:
+			for run in range(0,2):
+				d = pyparade.Dataset(list(range(0,1000)), name="Numbers")
+				result = d.map(add_one).map(add_one).fold(0, operator.add).collect(worker_pool=pool, status=False)
+				self.assertEqual(result[0], sum(range(2,1002)))
+
+	def test_worker_pool_stages(self):
+		with pyparade.WorkerPool(2) as pool:
+			watchdog = threading.Timer(120, pool.close) #waiting for a worker fails instead of hanging if the pool is closed
+			watchdog.start()
+			#every stage gets workers, although the stages before it keep their generators suspended while waiting for it
+			d = pyparade.Dataset(list(range(0,10000)), name="Numbers")
+			result = d.map(add_one_slowly).map(add_one).fold(0, operator.add).collect(worker_pool=pool, fuse=False, flush_policy="low_latency", status=False)
+			watchdog.cancel()
+		self.assertEqual([sum(range(2,10002))], result)
+
+	def test_backpressure(self):
+		d = pyparade.Dataset(list(range(0,5)), name="Numbers")
+		buf = d._get_buffer(size=1)
+		started = time.time()
+		filler = threading.Thread(target=d._fill_buffers)
+		filler.start()
+		self.assertEqual(list(range(0,5)), list(buf.generate()))
+		filler.join()
+		self.assertLess(time.time() - started, 0.9) #producer resumes as soon as the full buffer has been read
+
+	def test_buffer_batches(self):
+		d = pyparade.Dataset([], name="Empty")
+		buf = pyparade.Buffer(d, size=2)
+		buf.put([1,2,3])
+		buf.put([4])
+		self.assertTrue(buf.full())
+		self.assertEqual(len(buf), 4)
+		buf.end()
+		self.assertEqual([[1,2,3],[4]], list(buf.batches()))
+		self.assertEqual(len(buf), 0)
+		self.assertEqual([], list(buf.generate())) #end of stream stays signalled
+
+	def test_flush_policy(self):
+		self.assertTrue(pyparade.FlushPolicy(max_delay=0).should_flush(1, time.time()))
+		self.assertFalse(pyparade.FlushPolicy(max_delay=None, max_size=10).should_flush(9, 0))
+		self.assertTrue(pyparade.FlushPolicy(max_delay=None, max_size=10).should_flush(10, time.time()))
+		self.assertFalse(pyparade.FlushPolicy(max_delay=60).should_flush(1000, time.time()))
+
+		for flush_policy in ["low_latency", "high_throughput"]:
+			d = pyparade.Dataset(list(range(0,100)), name="Numbers")
+			result = d.map(add_one).flat_map(lambda a: [a, a], flush_policy="default").collect(flush_policy=flush_policy, status=False)
+			self.assertEqual([b for a in range(1,101) for b in [a, a]], result)
+
+	def test_iterate(self):
+		d = pyparade.Dataset(list(range(0,100)), name="Numbers")
+		self.assertEqual(list(range(1,101)), [a for a in d.map(add_one).iterate(status=False)])
+		self.assertEqual(list(range(1,101)), list(d.map(add_one))) #length of the result is not known before
+		self.assertRaises(TypeError, len, d.map(add_one))
+
+		result = []
+		d = pyparade.Dataset(list(range(0,100)), name="Numbers")
+		d.map(add_one).foreach(result.append, status=False)
+		self.assertEqual(list(range(1,101)), result)
+
+		d = pyparade.Dataset(range(0,10000000), name="Numbers")
+		mapped = d.map(add_one)
+		result = []
+		for a in mapped.iterate(status=False):
+			result.append(a)
+			if len(result) == 10:
+				break
+		self.assertEqual(list(range(1,11)), result)
+		self.assertTrue(d.finished.is_set()) #upstream stages have been stopped
+		mapped.source._thread.join(20)
+		self.assertFalse(mapped.source._thread.is_alive())
+
+		mapped = pyparade.Dataset(list(range(0,1000)), name="Numbers").map(add_one_slowly)
+		for a in mapped.iterate(status=False):
+			break
+		self.assertEqual(list(range(1,1001)), mapped.collect(status=False)) #stopping does not affect later processes
+
+	def test_broadcast_buffer(self):
+		d = pyparade.Dataset(list(range(0,1000)), name="Numbers", flush_policy="low_latency", spill_limit=1000)
+		fast = d._get_buffer(size=2)
+		slow = d._get_buffer(size=2)
+		filler = threading.Thread(target=d._fill_buffers)
+		filler.start()
+		self.assertEqual(list(range(0,1000)), list(fast.generate())) #slow consumer does not throttle the producer
+		filler.join()
+		self.assertEqual(1000, len(slow))
+		self.assertEqual(list(range(0,1000)), list(slow.generate()))
+		self.assertEqual(0, len(d._log._batches))
+
+	def test_memory_limit(self):
+		d = pyparade.Dataset([], name="Empty")
+		buf = pyparade.Buffer(d, size=30, log=pyparade.BroadcastBuffer(max_bytes=100000))
+		buf.put([b"x"*60000])
+		self.assertFalse(buf.full())
+		buf.put([b"x"*60000])
+		self.assertTrue(buf.full()) #limited by bytes, not by the number of batches
+
+		d = pyparade.Dataset([b"x"*100000 for i in range(0,200)], name="Wide records")
+		result = d.map(len).collect(memory_limit=1000000, buffer_bytes=500000, flush_policy="low_latency", status=False)
+		self.assertEqual([100000]*200, result)
+
+	def test_cache(self):
+		for storage in ["memory", "disk"]:
+			d = pyparade.Dataset(list(range(0,100)), name="Numbers")
+			mapped = d.map(add_one).cache(storage)
+			self.assertEqual(list(range(2,102)), mapped.map(add_one).collect(status=False))
+			self.assertTrue(mapped.is_cached())
+			started = mapped.source.time_started
+
+			self.assertEqual(list(range(1,101)), mapped.collect(status=False))
+			self.assertEqual(sum(range(2,102)), mapped.map(add_one).fold(0, operator.add).collect(status=False)[0])
+			self.assertEqual(started, mapped.source.time_started) #map was not run again
+
+			mapped.uncache()
+			self.assertEqual(list(range(1,101)), mapped.collect(status=False))
+			self.assertNotEqual(started, mapped.source.time_started)
+
+	def test_length_hint(self):
+		def numbers():
+			for i in range(0,100):
+				yield i
+
+		d = pyparade.Dataset(numbers(), length_hint=100)
+		self.assertEqual(100, d.estimated_length())
+		self.assertEqual(100, d.map(add_one).estimated_length()) #map outputs one element per input element
+		self.assertEqual(34, d.map(add_one).batch(3).estimated_length())
+		self.assertEqual(None, d.flat_map(lambda a: [a]).estimated_length())
+
+		d = pyparade.Dataset(numbers(), length_hint=lambda read: 2*read if read > 0 else None)
+		self.assertEqual(None, d.estimated_length())
+		self.assertEqual(list(range(1,101)), d.map(add_one).collect(status=False))
+		self.assertEqual(100, d.estimated_length()) #exact once the source is exhausted
+
+	def test_from_partitions(self):
+		partitions = [(i*100, (i+1)*100) for i in range(0,10)]
+		d = pyparade.Dataset.from_partitions(partitions, read_range, name="Numbers")
+		self.assertEqual(list(range(0,1000)), d.collect(status=False))
+		self.assertEqual(list(range(1,1001)), d.map(add_one).collect(status=False)) #reading and mapping are fused
+		d = pyparade.Dataset.from_partitions(partitions, read_range, ordered=False)
+		self.assertEqual(list(range(0,1000)), sorted(d.collect(status=False)))
+
+	def test_file_sources(self):
+		lines = ["line " + str(i) + "\n" for i in range(0,10000)] + ["no line ending"]
+		with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+			f.write("".join(lines))
+		try:
+			d = pyparade.Dataset.from_text_file(f.name, partition_bytes=1000)
+			self.assertAlmostEqual(10001, d.estimated_length(), delta=1000)
+			self.assertEqual(lines, d.collect(status=False))
+			self.assertEqual(10001, len(d))
+			self.assertRaises(ValueError, pyparade.Dataset.from_text_file, f.name, partition_bytes=0)
+			self.assertEqual(lines, pyparade.Dataset.from_text_file(f.name, encoding="latin-1", partition_bytes=1000).collect(status=False))
+		finally:
+			os.remove(f.name)
+
+		with tempfile.NamedTemporaryFile("w", encoding="utf-16", suffix=".txt", delete=False) as f:
+			f.write("".join(lines))
+		try: #newline bytes can be part of other characters in UTF-16 and UTF-32
+			for encoding in ["utf-16", "utf-16-le", "utf-32"]:
+				self.assertRaises(ValueError, pyparade.Dataset.from_text_file, f.name, encoding=encoding)
+		finally:
+			os.remove(f.name)
+
+		with tempfile.NamedTemporaryFile("wb", delete=False) as f:
+			f.write(b"".join([struct.pack("<ii", i, -i) for i in range(0,1000)]) + b"\0") #incomplete record is ignored
+		try:
+			d = pyparade.Dataset.from_binary_file(f.name, 8, partition_bytes=100)
+			self.assertEqual(1000, len(d))
+			self.assertEqual([(i, -i) for i in range(0,1000)], [struct.unpack("<ii", r) for r in d.collect(status=False)])
+			self.assertRaises(ValueError, pyparade.Dataset.from_binary_file, f.name, 8, partition_bytes=0)
+			self.assertRaises(ValueError, pyparade.Dataset.from_binary_file, f.name, 0)
+		finally:
+			os.remove(f.name)
+
+	def test_group_order(self):
+		pairs = [(k % 7, k) for k in range(100, 0, -1)]
+		d = pyparade.Dataset(pairs)
+		self.assertEqual([2, 1, 0, 6, 5, 4, 3], [k for k, values in d.group_by_key().collect(status=False)]) #order of first occurrence
+		self.assertEqual(list(range(0,7)), [k for k, values in d.group_by_key(sort=True).collect(status=False)])
+		self.assertEqual([(k, sum([v for key, v in pairs if key == k])) for k in range(0,7)], d.reduce_by_key(operator.add, sort=True).collect(status=False))
+		self.assertEqual(dict(d.reduce_by_key(operator.add).collect(status=False)), dict(d.reduce_by_key(operator.add, sort=True).collect(status=False)))
+
+	def test_partitioned_group(self):
+		pairs = [("key " + str(i % 100), i) for i in range(0,10000)]
+		expected = dict(pyparade.Dataset(pairs).group_by_key().collect(status=False))
+
+		result = pyparade.Dataset(pairs).group_by_key(num_partitions=8).collect(status=False)
+		self.assertEqual(100, len(result))
+		self.assertEqual(expected, dict([(k, sorted(values)) for k, values in result]))
+
+		result = pyparade.Dataset(pairs).group_by_key(num_partitions=3, sort=True, hash_func=len).collect(status=False)
+		self.assertEqual(sorted(expected.keys()), [k for k, values in result])
+
+	def test_combine(self):
+		lines = ["abc test abc test test xyz", "abc test2 abc test cde xyz"] * 1000
+		expected = [("abc", 4000), ("cde", 1000), ("test", 4000), ("test2", 1000), ("xyz", 2000)]
+
+		words = pyparade.Dataset(lines).flat_map(word_pairs)
+		self.assertEqual(expected, words.reduce_by_key(operator.add, sort=True).collect(status=False))
+		self.assertRaises(pyparade.LengthNotAvailableError, len, words) #only partial counts were sent back by the workers
+		self.assertEqual(None, words.estimated_length())
+
+		words = pyparade.Dataset(lines).flat_map(word_pairs).map(tuple)
+		self.assertEqual(expected, words.reduce_by_key(operator.add, sort=True, combine=False).collect(status=False))
+		self.assertEqual(12000, len(words))
+		self.assertEqual(expected, words.reduce_by_key(operator.add, sort=True).collect(status=False, fuse=False))
+		self.assertFalse(words.has_length())
+		self.assertEqual(12000, len(words.source.source)) #the datasets before the combined one are not affected
+
+	def test_external_group(self):
+		pairs = [(random.randint(0,500), i) for i in range(0,20000)]
+		expected = pyparade.Dataset(pairs).group_by_key(sort=True).collect(status=False)
+		self.assertEqual(expected, pyparade.Dataset(pairs).group_by_key(memory_limit=10000).collect(status=False)) #values stay in order
+		self.assertEqual(expected, pyparade.Dataset(pairs).group_by_key(memory_limit=10**9, sort=True).collect(status=False))
+
+	def test_aggregate(self):
+		d = pyparade.Dataset(list(range(0,10000)), name="Numbers")
+		self.assertEqual([(sum(range(0,10000)), 10000)], d.aggregate((0, 0), add_to_mean, combine_means).collect(status=False))
+		self.assertEqual([list(range(0,10000))], d.aggregate([], append, operator.add, chunkseconds=0.001).collect(status=False)) #order is kept
+		self.assertEqual([[]], pyparade.Dataset([]).aggregate([], append, operator.add).collect(status=False))
+		self.assertEqual([0], pyparade.Dataset([]).fold(0, operator.add).collect(status=False))
+
+	def test_fold_chunkseconds(self):
+		d = pyparade.Dataset(list(range(0,3000)), name="Numbers")
+		#each batch is folded into one partial result, whose third value counts the batches
+		[(total, count, batches)] = d.aggregate((0, 0, 1), add_slowly_to_mean, combine_batch_means, chunkseconds=0.05).collect(status=False)
+		self.assertEqual((sum(range(0,3000)), 3000), (total, count))
+		self.assertLess(count*0.001/batches, 0.1) #batches take about chunkseconds although folding happens after mapping
@@ -6,11 +6,23 @@ standard_library.install_aliases()
 from builtins import str
 from builtins import range
 from builtins import object
-import multiprocessing, time, math, traceback, queue
+import multiprocessing, threading, time, math, traceback, queue, pickle, ctypes, collections, inspect, zlib, numbers, os, stat, mmap, io
+import multiprocessing.connection
+from multiprocessing.reduction import ForkingPickler
 from multiprocessing import Process
 import multiprocessing
 import sys
 
+try:
+	from multiprocessing import shared_memory
+except ImportError: #shared memory is only available in Python 3.8+
+	shared_memory = None
+
+try:
+	import cloudpickle
+except ImportError: #cloudpickle is optional and only needed for the cloudpickle serializer
+	cloudpickle = None
+
 DEBUG = False
 
 def sstr(obj):
@@ -20,6 +32,21 @@ def sstr(obj):
 	except UnicodeEncodeError:
 		return str(obj).encode('utf-8')
 
+def is_coroutine_function(func):
+	"""Returns True if func is a coroutine function (defined with async def)"""
+	return hasattr(inspect, "iscoroutinefunction") and inspect.iscoroutinefunction(func)
+
+def is_importable(obj):
+	"""Returns True if obj (e.g. a function or class) can be looked up by its module and qualified name. 
+	Lambdas and functions defined inside of other functions cannot be looked up."""
+	try:
+		found = sys.modules[obj.__module__]
+		for name in obj.__qualname__.split("."):
+			found = getattr(found, name)
+		return found is obj
+	except (AttributeError, KeyError):
+		return False
+
 def shorten(text, max_length=140):
 	min_length = 0.8*max_length
 	shortstr = ""
@@ -37,6 +64,176 @@ def shorten(text, max_length=140):
 	return shortstr[:-1] + "..."
 
 
+def stable_hash(key):
+	"""Returns a hash of key that is the same in all processes. The built-in hash() of str and bytes 
+	is randomized per process, so it cannot be used to assign keys to partitions in different workers.
+	Supports None, numbers, str, bytes and tuples and frozensets of them, equal numbers (e.g. 1, 1.0 and True) have the same hash.
+	Raises a TypeError for other keys, pass a hash_func to handle them."""
+	if key is None:
+		return 0x2D5A9E1F
+	if isinstance(key, str):
+		return zlib.crc32(key.encode("utf-8", "surrogatepass"))
+	if isinstance(key, bytes):
+		return zlib.crc32(key)
+	if isinstance(key, numbers.Number):
+		if key != key: #the hash of NaN depends on the object
+			return 0x7FF80000
+		return hash(key) #the hashes of numbers are not randomized
+	if isinstance(key, tuple):
+		h = 0x345678
+		for k in key:
+			h = (h * 1000003) ^ stable_hash(k)
+		return h & 0xFFFFFFFF
+	if isinstance(key, frozenset):
+		h = len(key)
+		for k in key: #independent of the iteration order
+			h += stable_hash(k) * 69069
+		return h & 0xFFFFFFFF
+	raise TypeError("Cannot compute a stable hash for keys of type " + type(key).__name__)
+
+def estimate_size(values, samples = 8):
+	"""Cheaply estimates the memory used by a list of values in bytes by pickling a few sampled values.
+	Args:
+		values: a list of values
+		samples: the maximum number of values to pickle"""
+	if len(values) == 0:
+		return 0
+	step = max(1, len(values) // samples)
+	sample = values[::step][:samples]
+	return int(len(pickle.dumps(sample, pickle.HIGHEST_PROTOCOL)) * len(values) / len(sample))
+
+class MemoryBudget(object):
+	"""A memory limit shared by the buffers of a `pyparade.ParallelProcess`. Buffers allocate the estimated size of each batch 
+	they keep and free it when the batch is consumed. Producers have to wait while the limit is exceeded."""
+	def __init__(self, limit):
+		"""Args:
+			limit: the maximum number of bytes all buffers can use together"""
+		super(MemoryBudget, self).__init__()
+		self.limit = limit
+		self.used = 0
+		self._lock = threading.Lock()
+		self._listeners = []
+
+	def add_listener(self, listener):
+		"""Adds a function that is called when the used memory drops below the limit, for example to wake up waiting producers"""
+		self._listeners.append(listener)
+
+	def exceeded(self):
+		"""Returns True if the buffers use at least as much memory as the limit allows"""
+		return self.used >= self.limit
+
+	def allocate(self, nbytes):
+		with self._lock:
+			self.used += nbytes
+
+	def free(self, nbytes):
+		"""Frees nbytes and notifies the listeners if the used memory dropped below the limit. 
+		Must not be called while holding a lock that a listener acquires."""
+		with self._lock:
+			was_exceeded = self.exceeded()
+			self.used -= nbytes
+			dropped_below = was_exceeded and not self.exceeded()
+		if dropped_below:
+			for listener in self._listeners:
+				listener()
+
+class ByteOffsetEstimator(object):
+	"""Estimates the total number of elements of a source from the number of bytes it has read so far,
+	assuming that the elements read so far are representative for the rest. Can be used as length_hint of a `pyparade.Dataset`."""
+	def __init__(self, size, offset, initial = None):
+		"""Args:
+			size: the total number of bytes of the source
+			offset: a function that returns the number of bytes read so far
+			initial: the estimate returned before anything has been read (None if unknown)"""
+		super(ByteOffsetEstimator, self).__init__()
+		self.size = size
+		self.offset = offset
+		self.initial = initial
+
+	def __call__(self, elements_read):
+		"""Returns the estimated total number of elements or the initial estimate if nothing has been read yet"""
+		offset = self.offset()
+		if elements_read <= 0 or offset <= 0:
+			return self.initial
+		return int(math.ceil(elements_read * float(self.size) / offset))
+
+class FileSizeEstimator(ByteOffsetEstimator):
+	"""Estimates the number of elements (e.g. lines) of a file from its size and the current read position"""
+	def __init__(self, f):
+		"""Args:
+			f: a file object opened in text or binary mode"""
+		raw = getattr(f, "buffer", f) #the position of text files cannot be told while iterating over them
+		start = raw.tell()
+		super(FileSizeEstimator, self).__init__(os.fstat(f.fileno()).st_size - start, lambda: raw.tell() - start)
+
+def file_length_hint(source):
+	"""Returns a `pyparade.util.FileSizeEstimator` if source is a regular file, otherwise None"""
+	try:
+		if stat.S_ISREG(os.fstat(source.fileno()).st_mode):
+			return FileSizeEstimator(source)
+	except Exception as e:
+		pass
+	return None
+
+def text_file_partitions(path, partition_bytes):
+	"""Splits a text file into byte ranges of about partition_bytes that end at line boundaries. 
+	Returns a list of (path, start, end) tuples."""
+	if partition_bytes < 1:
+		raise ValueError("Illegal partition size")
+	partitions = []
+	with open(path, "rb") as f:
+		size = os.fstat(f.fileno()).st_size
+		if size == 0: #empty files cannot be mapped
+			return partitions
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+			start = 0
+			while start < size:
+				newline = mm.find(b"\n", min(start + partition_bytes, size) - 1)
+				end = newline + 1 if newline >= 0 else size
+				partitions.append((path, start, end))
+				start = end
+	return partitions
+
+def estimate_line_count(path, sample_bytes = 1024*1024):
+	"""Estimates the number of lines of a text file by counting the lines in its first sample_bytes"""
+	size = os.path.getsize(path)
+	if size == 0:
+		return 0
+	with open(path, "rb") as f:
+		sample = f.read(sample_bytes)
+	lines = sample.count(b"\n")
+	if len(sample) == size: #the whole file was read
+		return lines + (0 if sample.endswith(b"\n") else 1)
+	return int(math.ceil(max(1, lines) * float(size) / len(sample)))
+
+def record_file_partitions(path, record_size, partition_bytes):
+	"""Splits a file of fixed size records into byte ranges of about partition_bytes that contain whole records. 
+	Returns a list of (path, start, end) tuples, trailing bytes that do not form a whole record are left out."""
+	if record_size < 1:
+		raise ValueError("Illegal record size")
+	if partition_bytes < 1:
+		raise ValueError("Illegal partition size")
+	size = os.path.getsize(path) // record_size * record_size
+	step = max(1, partition_bytes // record_size) * record_size
+	return [(path, start, min(start + step, size)) for start in range(0, size, step)]
+
+def _map_range(partition):
+	path, start, end = partition
+	with open(path, "rb") as f:
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+			return mm[start:end]
+
+def read_text_range(partition, encoding = None, errors = None):
+	"""Returns the lines of a byte range of a text file (see `pyparade.util.text_file_partitions`) 
+	like iterating over the opened file would, including the line endings"""
+	with io.TextIOWrapper(io.BytesIO(_map_range(partition)), encoding=encoding, errors=errors) as f:
+		return list(f)
+
+def read_record_range(partition, record_size):
+	"""Returns the records of a byte range of a file of fixed size records as bytes (see `pyparade.util.record_file_partitions`)"""
+	data = _map_range(partition)
+	return [data[i:i+record_size] for i in range(0, len(data), record_size)]
+
 class Event(object):
 	"""An event that can have multiple handlers """
 	def __init__(self):
@@ -86,22 +283,715 @@ class Timer(object):
 		self.seconds = self.end-self.start
 		print(self.description + " took " + str(self.seconds) + "s.")
 
+_COMPRESSED = b"Z" #marks compressed payloads, pickle streams (protocol 2+) always start with b"\x80"
+
+class PickleSerializer(object):
+	"""Serializes batches, results and tasks sent to and from workers with pickle (default). 
+	Functions are pickled by reference, so map functions have to be defined at module level."""
+	def __init__(self, protocol = None):
+		"""Args:
+			protocol: the pickle protocol to use (defaults to the default protocol of multiprocessing)"""
+		self.protocol = protocol
+
+	def dumps(self, obj, buffer_callback = None):
+		"""Serializes obj and returns a bytes-like object. If buffer_callback is given, obj is pickled with protocol 5 
+		and out-of-band buffers are passed to buffer_callback instead of being copied into the stream."""
+		if buffer_callback != None:
+			return pickle.dumps(obj, protocol=5, buffer_callback=buffer_callback)
+		return ForkingPickler.dumps(obj, self.protocol)
+
+class Pickle5Serializer(PickleSerializer):
+	"""Serializes with pickle protocol 5, which stores large bytes and bytearrays more efficiently"""
+	def __init__(self):
+		if pickle.HIGHEST_PROTOCOL < 5:
+			raise ValueError("Pickle protocol 5 requires Python 3.8 or newer")
+		super(Pickle5Serializer, self).__init__(5)
+
+class CloudPickleSerializer(PickleSerializer):
+	"""Serializes with cloudpickle, which pickles lambdas, closures and functions defined in __main__ by value, 
+	such that they can be used as map functions with the spawn start method. Requires the cloudpickle package."""
+	def __init__(self, protocol = None):
+		if cloudpickle == None:
+			raise ValueError("The cloudpickle serializer requires the cloudpickle package")
+		super(CloudPickleSerializer, self).__init__(protocol)
+
+	def dumps(self, obj, buffer_callback = None):
+		if buffer_callback != None:
+			return cloudpickle.dumps(obj, protocol=5, buffer_callback=buffer_callback)
+		return cloudpickle.dumps(obj, self.protocol)
+
+class CompressingSerializer(PickleSerializer):
+	"""Compresses the output of another serializer with zlib. Trades CPU time for fewer bytes, 
+	which pays off for large, redundant elements like text. Out-of-band buffers are not compressed."""
+	def __init__(self, serializer = "pickle", level = 1):
+		"""Args:
+			serializer: the serializer whose output is compressed (see SERIALIZERS)
+			level: the zlib compression level from 1 (fastest) to 9 (smallest)"""
+		super(CompressingSerializer, self).__init__()
+		self.serializer = get_serializer(serializer)
+		self.level = level
+
+	def dumps(self, obj, buffer_callback = None):
+		return _COMPRESSED + zlib.compress(self.serializer.dumps(obj, buffer_callback), self.level)
+
+SERIALIZERS = {
+	"pickle": PickleSerializer,
+	"pickle5": Pickle5Serializer,
+	"cloudpickle": CloudPickleSerializer,
+	"zlib": CompressingSerializer
+}
+
+def get_serializer(serializer):
+	"""Returns a serializer instance.
+	Args:
+		serializer: the name of a serializer (see SERIALIZERS) or a serializer instance"""
+	if isinstance(serializer, PickleSerializer):
+		return serializer
+	if serializer in SERIALIZERS:
+		return SERIALIZERS[serializer]()
+	raise ValueError("Unknown serializer: " + sstr(serializer))
+
+def deserialize(data, buffers = None):
+	"""Deserializes data created by any of the serializers, so receivers do not need to know which serializer was used.
+	Args:
+		data: a bytes-like object
+		buffers: out-of-band buffers of a protocol 5 pickle stream"""
+	if bytes(data[:1]) == _COMPRESSED:
+		data = zlib.decompress(data[1:])
+	if buffers != None:
+		return pickle.loads(data, buffers=buffers)
+	return pickle.loads(data)
+
+class _Serialized(object):
+	"""An object that has been serialized in advance, for example a task that is passed to a spawned worker process"""
+	def __init__(self, obj, serializer):
+		self.data = bytes(serializer.dumps(obj))
+
+	def load(self):
+		return deserialize(self.data)
+
+class PipeTransport(object):
+	"""Transfers batches and results between the coordinator and the workers of a `pyparade.util.ParMap` 
+	by sending them through the worker pipe (default)"""
+	def __init__(self, serializer = "pickle"):
+		"""Args:
+			serializer: how objects are serialized, the name of a serializer (see SERIALIZERS) or a serializer instance"""
+		self.serializer = get_serializer(serializer)
+
+	def send(self, conn, obj):
+		"""Sends obj through the connection conn. Returns the size of the serialized object in bytes."""
+		data = self.serializer.dumps(obj)
+		conn.send_bytes(data)
+		return len(data)
+
+	def recv(self, conn):
+		"""Receives the next object from the connection conn. Payloads sent by any transport are accepted."""
+		return self.recv_sized(conn)[0]
+
+	def recv_sized(self, conn):
+		"""Receives the next object from the connection conn and returns it together with its serialized size in bytes"""
+		data = conn.recv_bytes()
+		message = deserialize(data)
+		if isinstance(message, SharedMemoryRef):
+			return (message.load(), message.nbytes)
+		return (message, len(data))
+
+class SharedMemoryRef(object):
+	"""Describes a payload that has been put into a shared memory segment by a `pyparade.util.SharedMemoryTransport`"""
+	def __init__(self, name, sizes):
+		"""Args:
+			name: the name of the shared memory segment
+			sizes: the sizes of the pickle stream and of all out-of-band buffers stored after each other in the segment"""
+		self.name = name
+		self.sizes = sizes
+
+	@property
+	def nbytes(self):
+		"""The size of the payload in bytes"""
+		return sum(self.sizes)
+
+	def load(self):
+		"""Unpickles the payload and unlinks the shared memory segment"""
+		segment = shared_memory.SharedMemory(name=self.name)
+		try:
+			#out-of-band buffers are copied, such that the segment can be released right away
+			pos = self.sizes[0]
+			buffers = []
+			for size in self.sizes[1:]:
+				buffers.append(bytearray(segment.buf[pos:pos+size]))
+				pos += size
+
+			stream = segment.buf[0:self.sizes[0]]
+			try:
+				return deserialize(stream, buffers)
+			finally:
+				stream.release()
+		finally:
+			segment.close()
+			segment.unlink()
+
+class SharedMemoryTransport(PipeTransport):
+	"""Transfers batches and results in shared memory segments and only sends a small descriptor through the worker pipe.
+	Payloads are pickled with protocol 5, such that objects supporting out-of-band buffers (for example NumPy arrays) 
+	are copied into the segment directly instead of being pickled. The receiver unlinks the segment after reading it."""
+	def __init__(self, serializer = "pickle"):
+		super(SharedMemoryTransport, self).__init__(serializer)
+		if shared_memory == None or pickle.HIGHEST_PROTOCOL < 5:
+			raise ValueError("Shared memory transport requires Python 3.8 or newer")
+
+	def send(self, conn, obj):
+		if obj is None: #control messages are sent directly
+			return super(SharedMemoryTransport, self).send(conn, obj)
+
+		buffers = []
+		parts = [memoryview(self.serializer.dumps(obj, buffer_callback=buffers.append))]
+		parts.extend(buffer.raw() for buffer in buffers)
+		sizes = [part.nbytes for part in parts]
+
+		segment = shared_memory.SharedMemory(create=True, size=max(1, sum(sizes)))
+		pos = 0
+		for part, size in zip(parts, sizes):
+			segment.buf[pos:pos+size] = part
+			pos += size
+		segment.close()
+
+		super(SharedMemoryTransport, self).send(conn, SharedMemoryRef(segment.name, sizes))
+		return sum(sizes)
+
+TRANSPORTS = {
+	"pipe": PipeTransport,
+	"shared_memory": SharedMemoryTransport
+}
+
+def get_transport(transport, serializer = "pickle"):
+	"""Returns a transport instance for a `pyparade.util.ParMap`.
+	Args:
+		transport: the name of a transport (see TRANSPORTS) or a transport instance
+		serializer: the serializer used by a new transport (see SERIALIZERS), transport instances keep their own serializer"""
+	if isinstance(transport, PipeTransport):
+		return transport
+	if transport in TRANSPORTS:
+		return TRANSPORTS[transport](serializer)
+	raise ValueError("Unknown transport: " + sstr(transport))
+
+class WorkerPool(object):
+	"""A pool of long-lived worker processes that can be shared by several `pyparade.util.ParMap` objects, 
+	for example by all operations of a `pyparade.ParallelProcess` and across several runs.
+	Workers keep the contexts returned by a context_func open until the pool is closed, 
+	such that resources like database connections stay available between jobs."""
+	MAX_TASKS = 256
+
+	def __init__(self, num_workers=multiprocessing.cpu_count()):
+		"""Creates a new worker pool. The worker processes are started when the pool is used for the first time.
+		Map and context functions of tasks registered after the workers have been started are sent to the workers, 
+		so they have to be pickable by the serializer of the task (for example functions defined at module level, or lambdas with the cloudpickle serializer).
+		Args:
+			num_workers: the number of worker processes to spawn (defaults to the number of CPU cores available)
+		"""
+		super(WorkerPool, self).__init__()
+		self.num_workers = num_workers
+		self.workers = []
+		self.free_workers = collections.deque()
+		self._tasks = {}
+		self._next_task_id = 0
+		self._free_slots = list(range(self.MAX_TASKS))
+		self._stop_flags = multiprocessing.Array(ctypes.c_bool, self.MAX_TASKS, lock=False)
+		self._lock = threading.Lock()
+		self._available = threading.Condition(self._lock)
+		self._collector = None
+		self._started = False
+		self._closed = False
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.close()
+
+	def register(self, map_func, context_func = None, transport = "pipe", concurrency = 100, combine_func = None):
+		"""Registers a task that can be executed by the workers and returns its id.
+		Args:
+			map_func: the function to apply to each element. Can be a coroutine function (async def).
+			context_func: an optional function that returns a context manager or an asynchronous context manager. 
+						  The context is entered once per worker and kept open until the pool is closed.
+			transport: the transport used to send results back to the coordinator
+			concurrency: the maximum number of calls of a coroutine map_func that run at the same time in each worker
+			combine_func: an optional function that is applied to the list of results of each batch in the worker 
+						  and returns the list of results that is sent back (for example partial aggregates). 
+						  The context object is passed as the second argument if there is a context."""
+		with self._lock:
+			if self._closed:
+				raise RuntimeError("Worker pool is closed")
+			if len(self._free_slots) == 0:
+				raise RuntimeError("Too many tasks registered at the worker pool")
+			task_id = self._next_task_id
+			self._next_task_id += 1
+			slot = self._free_slots.pop()
+			self._stop_flags[slot] = False
+			self._tasks[task_id] = {"map_func": map_func, "context_func": context_func, "transport": get_transport(transport), "slot": slot, 
+									"is_async": is_coroutine_function(map_func), "concurrency": concurrency, 
+									"combine_func": combine_func}
+			return task_id
+
+	def unregister(self, task_id):
+		"""Removes a task from the pool. Workers that know the task drop it and exit its context, 
+		unless the context_func can be looked up by name and thus be registered again (see `pyparade.util.is_importable`)."""
+		with self._lock:
+			task = self._tasks.pop(task_id)
+			self._stop_flags[task["slot"]] = False
+			self._free_slots.append(task["slot"])
+			workers = list(self.workers)
+
+		for worker in workers:
+			with worker["send_lock"]:
+				if task_id in worker["tasks"]:
+					worker["tasks"].discard(task_id)
+					try:
+						self._send_message(worker, task, ("unregister", task_id))
+					except Exception as e: #worker has gone away
+						pass
+
+	def stop_task(self, task_id):
+		"""Requests all workers to stop processing batches of the given task"""
+		with self._lock:
+			if task_id in self._tasks:
+				self._stop_flags[self._tasks[task_id]["slot"]] = True
+
+	def acquire(self, block = True, timeout = None):
+		"""Returns a free worker and starts the worker processes if necessary. Raises queue.Empty if no worker is available.
+		The worker is handed back to the pool as soon as all batches submitted to it are finished, even if their results 
+		have not been processed yet. Workers that are not used after all have to be handed back using `pyparade.util.WorkerPool.release`."""
+		self._start()
+		with self._available:
+			if not self._available.wait_for(lambda: len(self.free_workers) > 0 or self._closed, timeout if block else 0):
+				raise queue.Empty()
+			if self._closed:
+				raise RuntimeError("Worker pool is closed")
+			worker = self.free_workers.popleft()
+			worker["free"] = False
+			return worker
+
+	def release(self, worker):
+		"""Hands a worker back to the pool if no batches are queued at it"""
+		with self._lock:
+			if len(worker["jobs"]) == 0:
+				self._hand_back(worker)
+
+	def _hand_back(self, worker):
+		"""Puts a worker back into the queue of free workers. Has to be called while holding the lock."""
+		if not worker["free"] and not worker["lost"]:
+			worker["free"] = True
+			self.free_workers.append(worker)
+			self._available.notify()
+
+	def submit(self, worker, task_id, batch, done):
+		"""Sends a batch of the task to the worker. The worker has to be acquired before, more batches can be queued at it 
+		as long as the batches submitted before are not finished. Returns the size of the batch in bytes.
+		Args:
+			worker: the worker that processes the batch
+			task_id: the id of a registered task
+			batch: a list of elements
+			done: a function that is called with the jobinfo dictionary of the finished batch and the size of the results in bytes. 
+				  It is called by the thread receiving the results, so it should only hand them over to the submitting thread."""
+		with worker["send_lock"]:
+			with self._lock:
+				worker["jobs"].append(done)
+				if worker["free"]: #batch is queued at a worker that has been handed back in the meantime
+					self.free_workers.remove(worker)
+					worker["free"] = False
+			try:
+				return self._send(worker, task_id, batch)
+			except BaseException as e:
+				with self._lock:
+					worker["jobs"].pop()
+					if len(worker["jobs"]) == 0:
+						self._hand_back(worker)
+				raise
+
+	def _send(self, worker, task_id, batch):
+		"""Sends a batch to the worker and returns its size in bytes"""
+		task = self._tasks[task_id]
+		if not task_id in worker["tasks"]: #worker was started before the task was registered
+			self._send_message(worker, task, ("task", task_id, task))
+			worker["tasks"].add(task_id)
+		return self._send_message(worker, task, ("batch", task_id, batch))
+
+	def _send_message(self, worker, task, message):
+		"""Sends a message to the worker with the transport of the task and returns its size in bytes"""
+		return task["transport"].send(worker["connection"], message)
+
+	def _finish(self, worker, jobinfo, nbytes):
+		"""Passes the result of the oldest batch queued at the worker to its submitter and hands the worker back to the pool if it has nothing left to do"""
+		with self._lock:
+			done = worker["jobs"].popleft()
+			if len(worker["jobs"]) == 0:
+				self._hand_back(worker)
+		done(jobinfo, nbytes)
+
+	def _lose(self, worker):
+		"""Fails all batches queued at a worker that has gone away and replaces the worker, unless the pool is closed.
+		Returns the new worker or None."""
+		replacement = None
+		with self._lock:
+			worker["lost"] = True
+			jobs = list(worker["jobs"])
+			worker["jobs"].clear()
+			if worker["free"]:
+				self.free_workers.remove(worker)
+				worker["free"] = False
+			if not self._closed:
+				replacement = self._new_worker()
+				self.workers[self.workers.index(worker)] = replacement
+				self._hand_back(replacement)
+		for done in jobs:
+			jobinfo = {}
+			jobinfo["error"] = (RuntimeError, "worker has gone away", "")
+			jobinfo["stopped"] = time.time()
+			done(jobinfo, 0)
+		return replacement
+
+	def _collect(self):
+		"""Receives the results of all workers, such that workers are handed back to the pool as soon as their batches are finished, 
+		also while the users of the pool are not waiting for results (e.g. while the generator of a `pyparade.util.ParMap` is suspended)"""
+		receiver = PipeTransport()
+		workers = dict((worker["connection"], worker) for worker in self.workers)
+		while len(workers) > 0:
+			for conn in multiprocessing.connection.wait(list(workers.keys())):
+				worker = workers[conn]
+				try:
+					jobinfo, nbytes = receiver.recv_sized(conn)
+				except (EOFError, OSError): #worker has been shut down or died
+					del workers[conn]
+					replacement = self._lose(worker)
+					if replacement != None:
+						workers[replacement["connection"]] = replacement
+					continue
+				except Exception as e: #result could not be deserialized
+					ex_type, ex_value, tb = sys.exc_info()
+					jobinfo = {}
+					jobinfo["error"] = (ex_type, ex_value, ''.join(traceback.format_tb(tb)))
+					jobinfo["stopped"] = time.time()
+					nbytes = 0
+				self._finish(worker, jobinfo, nbytes)
+
+	def _start(self):
+		with self._lock:
+			if self._started:
+				return
+			if self._closed:
+				raise RuntimeError("Worker pool is closed")
+			self._started = True
+
+			#workers have to share the resource tracker of the coordinator, otherwise shared memory segments unlinked by the receiver are reported as leaked
+			if shared_memory != None:
+				from multiprocessing import resource_tracker
+				resource_tracker.ensure_running()
+
+			for i in range(self.num_workers):
+				worker = self._new_worker()
+				self.workers.append(worker)
+				self._hand_back(worker)
+			self._start_collector()
+
+	def _new_worker(self):
+		"""Starts a new worker that knows all registered tasks. Has to be called while holding the lock."""
+		worker = {}
+		worker["tasks"] = set(self._tasks.keys())
+		worker["jobs"] = collections.deque() #result handlers of the batches queued at the worker in order of processing
+		worker["send_lock"] = threading.Lock()
+		worker["free"] = False
+		worker["lost"] = False
+		self._start_worker(worker)
+		return worker
+
+	def _start_worker(self, worker):
+		"""Starts a worker process that communicates through a pipe"""
+		parent_conn, child_conn = multiprocessing.Pipe()
+		worker["connection"] = parent_conn
+		worker["process"] = self._create_worker(child_conn)
+		worker["process"].daemon = True #do not block interpreter exit if the pool is not closed
+		worker["process"].start()
+		child_conn.close() #the collector only sees the end of a worker if all copies of its connection are closed
+
+	def _start_collector(self):
+		self._collector = threading.Thread(target=self._collect, name="Collector")
+		self._collector.daemon = True
+		self._collector.start()
+
+	def _create_worker(self, conn):
+		"""Returns a new (not yet started) worker process that communicates through conn"""
+		tasks = dict(self._tasks)
+		if hasattr(multiprocessing, "get_start_method") and multiprocessing.get_start_method() != "fork":
+			#arguments of spawned workers are pickled, so tasks are serialized with the serializer of their transport instead (e.g. cloudpickle for lambdas)
+			tasks = dict((task_id, _Serialized(task, task["transport"].serializer)) for task_id, task in tasks.items())
+		return Process(target = _work, args=(conn, tasks, self._stop_flags))
+
+	def close(self):
+		"""Shuts down all worker processes and closes their contexts. Workers that are still in use are shut down as well."""
+		with self._lock:
+			self._closed = True
+			for slot in range(self.MAX_TASKS):
+				self._stop_flags[slot] = True
+			self._available.notify_all()
+		
+		for worker in self.workers:
+			try:
+				with worker["send_lock"]:
+					worker["connection"].send(None) #send shutdown command
+			except Exception as e:
+				pass
+		for worker in self.workers:
+			worker["process"].join()
+		if self._collector != None: #collector stops when all workers have gone away
+			self._collector.join()
+		for worker in self.workers:
+			worker["connection"].close()
+
+class ThreadWorkerPool(WorkerPool):
+	"""A pool of worker threads that can be used instead of worker processes for I/O bound map functions, 
+	for example functions that mostly wait for network or database requests. Threads are much cheaper than processes, 
+	so hundreds of them can run concurrently. Each thread has its own context, like a worker process.
+	Batches and results are handed over to the threads as they are, so they are neither serialized nor limited by chunkbytes."""
+	def __init__(self, num_workers=10*multiprocessing.cpu_count()):
+		"""Creates a new thread pool. The threads are started when the pool is used for the first time.
+		Args:
+			num_workers: the number of worker threads (defaults to 10 times the number of CPU cores available)
+		"""
+		super(ThreadWorkerPool, self).__init__(num_workers)
+
+	def _send_message(self, worker, task, message):
+		#tasks and batches are handed over to the threads as they are, so functions and elements never need to be pickled
+		worker["connection"].send(message)
+		return 0
+
+	def _start_worker(self, worker):
+		worker["connection"] = _ThreadChannel(self, worker)
+		worker["process"] = threading.Thread(target = _work, args=(worker["connection"], dict(self._tasks), self._stop_flags), name="Worker")
+		worker["process"].daemon = True
+		worker["process"].start()
+
+	def _start_collector(self):
+		pass #worker threads hand their results to the pool themselves
+
+class _ThreadChannel(object):
+	"""Connects the coordinator with a worker thread of a `pyparade.util.ThreadWorkerPool` using an in-process queue"""
+	def __init__(self, pool, worker):
+		self.inbox = queue.Queue()
+		self._pool = pool
+		self._worker = worker
+
+	def send(self, message):
+		"""Queues a message at the worker thread"""
+		self.inbox.put(message)
+
+	def finish(self, jobinfo):
+		"""Passes the result of a batch from the worker thread to the pool"""
+		self._pool._finish(self._worker, jobinfo, 0)
+
+	def close(self):
+		pass
+
+BACKENDS = {
+	"processes": WorkerPool,
+	"threads": ThreadWorkerPool
+}
+
+def _receive_messages(conn, inbox):
+	"""Reads all incoming messages of a worker into its local inbox, such that prefetched batches 
+	are available as soon as the current batch is finished and the coordinator never blocks on sending"""
+	receiver = PipeTransport()
+	try:
+		while True:
+			message = receiver.recv(conn)
+			inbox.put(message)
+			if message == None: #shutdown requested
+				return
+	except (EOFError, OSError): #coordinator has gone away
+		inbox.put(None)
+
+def _work(conn, tasks, stop_flags):
+	"""Main loop of a worker process of a `pyparade.util.WorkerPool` or a worker thread of a `pyparade.util.ThreadWorkerPool`"""
+	for task_id, task in list(tasks.items()):
+		if isinstance(task, _Serialized):
+			tasks[task_id] = task.load()
+
+	if isinstance(conn, _ThreadChannel):
+		inbox = conn.inbox
+	else:
+		inbox = queue.Queue()
+		reader = threading.Thread(target=_receive_messages, args=(conn, inbox), name="Receiver")
+		reader.daemon = True
+		reader.start()
+
+	state = {"contexts": {}, "loop": None}
+	try:
+		while True:
+			message = inbox.get()
+			if message == None: #shutdown requested
+				break
+
+			if message[0] == "task":
+				tasks[message[1]] = message[2]
+			elif message[0] == "unregister":
+				_drop_task(tasks, message[1], state)
+			elif message[0] == "batch":
+				task = tasks[message[1]]
+				started = time.time()
+				jobinfo = _run_task(task, message[2], state, stop_flags)
+				jobinfo["started"] = started #processing time without the time the batch was queued at the worker
+				if isinstance(conn, _ThreadChannel):
+					conn.finish(jobinfo)
+				else:
+					task["transport"].send(conn, jobinfo)
+	except (EOFError, OSError): #coordinator has gone away
+		pass
+	finally:
+		for context_func in list(state["contexts"].keys()):
+			_exit_context(state, context_func)
+		if state["loop"] != None:
+			from pyparade.util import aio
+			aio.close(state)
+		conn.close()
+
+def _exit_context(state, context_func):
+	"""Exits the context a worker has entered for context_func"""
+	context_manager, context, error = state["contexts"].pop(context_func)
+	if context_manager != None:
+		try:
+			if hasattr(context_manager, "__aexit__"):
+				from pyparade.util import aio
+				aio.run(state, context_manager.__aexit__(None, None, None))
+			else:
+				context_manager.__exit__(None, None, None)
+		except Exception as e:
+			pass
+
+def _drop_task(tasks, task_id, state):
+	"""Removes an unregistered task from a worker and exits its context if no other task can use it anymore"""
+	context_func = tasks.pop(task_id)["context_func"]
+	if context_func in state["contexts"] and not is_importable(context_func) and not any(task["context_func"] is context_func for task in tasks.values()):
+		_exit_context(state, context_func)
+
+def _run_task(task, batch, state, stop_flags):
+	"""Runs the map function of a task on a batch and returns a jobinfo dictionary containing the results or an error"""
+	contexts = state["contexts"]
+	context_func = task["context_func"]
+	context = None
+	if context_func != None:
+		if not context_func in contexts: #initialize context once per worker
+			try:
+				context_manager = context_func()
+				if hasattr(context_manager, "__aenter__"): #asynchronous context manager
+					from pyparade.util import aio
+					contexts[context_func] = (context_manager, aio.run(state, context_manager.__aenter__()), None)
+				else:
+					contexts[context_func] = (context_manager, context_manager.__enter__(), None)
+			except Exception as e: #worker not initialized, return error for all incoming jobs
+				ex_type, ex_value, tb = sys.exc_info()
+				contexts[context_func] = (None, None, (ex_type, ex_value, ''.join(traceback.format_tb(tb))))
+
+		context_manager, context, error = contexts[context_func]
+		if error != None:
+			jobinfo = {}
+			jobinfo["error"] = error
+			jobinfo["stopped"] = time.time()
+			return jobinfo
+
+	if task["is_async"]:
+		from pyparade.util import aio
+		jobinfo = aio.map_batch(state, task["map_func"], batch, context_func != None, context, stop_flags, task["slot"], task["concurrency"])
+	else:
+		jobinfo = _map_batch(task["map_func"], batch, context_func != None, context, stop_flags, task["slot"])
+
+	if task["combine_func"] != None and "results" in jobinfo:
+		try:
+			if context_func != None:
+				jobinfo["results"] = task["combine_func"](jobinfo["results"], context)
+			else:
+				jobinfo["results"] = task["combine_func"](jobinfo["results"])
+			jobinfo["stopped"] = time.time() #combining is part of the processing time that chunksizes are based on
+		except Exception as e:
+			ex_type, ex_value, tb = sys.exc_info()
+			jobinfo = {}
+			jobinfo["error"] = (ex_type, ex_value, ''.join(traceback.format_tb(tb)))
+			jobinfo["stopped"] = time.time()
+	return jobinfo
+
+def _map_batch(map_func, batch, use_context, context, stop_flags, slot):
+	results = []
+	for value in batch:
+		if stop_flags[slot]:
+			jobinfo = {}
+			jobinfo["error"] = (Exception, "stop requested", "")
+			jobinfo["stopped"] = time.time()
+			return jobinfo
+		try:
+			if use_context:
+				results.append(map_func(value, context))
+			else:
+				results.append(map_func(value))
+		except Exception as e:
+			ex_type, ex_value, tb = sys.exc_info()
+			error = ex_type, ex_value, ''.join(traceback.format_tb(tb))
+			
+			jobinfo = {}
+			jobinfo["error"] = error
+			jobinfo["stopped"] = time.time()
+			return jobinfo
+
+	jobinfo = {}
+	jobinfo["stopped"] = time.time()
+	jobinfo["results"] = results
+	return jobinfo
+
 class ParMap(object):
 	"""Parallel executes a map in several processes"""
-	def __init__(self, map_func, num_workers=multiprocessing.cpu_count(), context_func = None):
+	def __init__(self, map_func, num_workers=multiprocessing.cpu_count(), context_func = None, transport = "pipe", pool = None, ordered = True, prefetch = 1, backend = "processes", concurrency = 100, chunkseconds = 3.0, chunkbytes = 16*1024*1024, serializer = "pickle", combine_func = None):
 		"""A parallel implementation of map() that uses multiple processes to divide the compuation.
 		Args:
-			map_func: the function to apply to each element
-			context_func: an optional function that returns a context object (that could be used in a with block). The function is called once for each worker and the context object is passed to the map_func.
-			num_workers: the number of worker processes to spawn (defaults to the number of CPU cores available)
+			map_func: the function to apply to each element. Coroutine functions (async def) are run on an event loop in each worker.
+			context_func: an optional function that returns a context object (that could be used in a with block or an async with block). The function is called once for each worker and the context object is passed to the map_func.
+			num_workers: the number of worker processes (or threads) to spawn (defaults to the number of CPU cores available)
+			transport: how batches and results are transferred to and from the workers. "pipe" (default) sends them through the worker pipe,
+					   "shared_memory" puts them into shared memory segments and only sends small descriptors (useful for large elements)
+			pool: an optional `pyparade.util.WorkerPool` whose workers are used instead of spawning new worker processes for each call of map()
+			ordered: if True (default), results are returned in the order of the input. If False, the results of each batch are returned 
+					 as soon as the batch is finished, such that a slow batch does not hold back the results of batches finished after it
+			prefetch: the number of batches that are queued at each worker in addition to the batch it is currently processing, 
+					  such that workers do not idle while results and new batches are transferred (0 disables prefetching). 
+					  Workers of a pool are handed back as soon as their queued batches are finished, also while the generator is suspended.
+			backend: "processes" (default) runs map_func in worker processes, "threads" runs it in worker threads of the current process 
+					 (see `pyparade.util.ThreadWorkerPool`). Ignored if a pool is given.
+			concurrency: the maximum number of calls of a coroutine map_func that run at the same time in each worker
+			chunkseconds: the targeted processing time of a batch in seconds
+			chunkbytes: the maximum size of a batch and its results in bytes (None for no limit). Batches are limited by 
+						chunkseconds and chunkbytes, whatever is reached first.
+			serializer: how batches, results and functions are serialized (see SERIALIZERS). "pickle" (default), "pickle5", 
+						"cloudpickle" (supports lambdas and closures, requires the cloudpickle package), "zlib" (compressed pickle) 
+						or a serializer instance. Ignored if transport is a transport instance.
+			combine_func: an optional function that the workers apply to the list of results of each batch before sending 
+						  them back, for example to pre-aggregate them. map() then returns the combined results.
 		"""
 		super(ParMap, self).__init__()
 		self.map_func = map_func
 		self.context_func = context_func
-		self.num_workers = num_workers
-		self.request_stop = multiprocessing.Event()
+		self.pool = pool
+		if pool != None:
+			self.num_workers = pool.num_workers
+		else:
+			self.num_workers = num_workers
+		self.transport = get_transport(transport, serializer)
+		self.ordered = ordered
+		self.prefetch = prefetch
+		if not backend in BACKENDS:
+			raise ValueError("Unknown backend: " + sstr(backend))
+		self.backend = backend
+		self.concurrency = concurrency
+		self._task = None
 		self._chunksize = 1
-		self.chunkseconds = 3.0
+		self.chunkseconds = chunkseconds
+		self.chunkbytes = chunkbytes
+		self.combine_func = combine_func
 
 	@property
 	def chunksize(self):
@@ -110,17 +1000,112 @@ class ParMap(object):
 	def stop(self):
 		"""Requests all active workers connected to a running parallel mapping to stop.
 		Note that stopping workers is done asynchrously and can take while, even though this function returns immediately."""
-		self.request_stop.set()
+		task = self._task
+		if task != None:
+			task[0].stop_task(task[1])
 
-	def job_is_finished(self, job, timeout = 0.0):
-		if "stopped" in job:
-			return True
-		elif job["worker"] != None:
-			return job["worker"]["connection"].poll(timeout)
-		else:
-			return False
+	def _receive(self, jobs, running, job, jobinfo, nbytes):
+		"""Stores the result of a finished job, which is the oldest of our jobs queued at its worker"""
+		conn = job["worker"]["connection"]
+		running[conn].popleft()
+		if len(running[conn]) == 0:
+			del running[conn]
+		job.update(jobinfo)
+		job["bytes"] += nbytes
+		job["worker"] = None
+		if not self.ordered: #jobs are queued in order of completion
+			jobs.append(job)
+
+	def _receive_finished(self, jobs, running, timeout = 0.0):
+		"""Receives the results of all finished jobs. Blocks up to timeout seconds (or forever if timeout is None) until any job has finished."""
+		if len(running) == 0:
+			return
+		try:
+			finished = self._finished_jobs.get(timeout != 0.0, timeout)
+			while True:
+				self._receive(jobs, running, *finished)
+				finished = self._finished_jobs.get(False)
+		except queue.Empty:
+			pass
+
+	def _acquire_worker(self, pool, jobs, running):
+		"""Returns a free worker of the pool or a worker that has space left in its prefetch queue, 
+		receives results of finished jobs while all workers are busy"""
+		while True:
+			try:
+				return pool.acquire(False)
+			except queue.Empty:
+				pass
+
+			#queue the batch at the least busy of our workers
+			prefetchable = [queued for queued in running.values() if len(queued) <= self.prefetch]
+			if len(prefetchable) > 0:
+				return min(prefetchable, key=len)[0]["worker"]
+
+			if len(running) > 0: #wait until one of our jobs finished and its worker is handed back
+				self._receive_finished(jobs, running, timeout = None)
+			else: #all workers are busy with jobs of other users of the pool, which are handed back as soon as they are finished
+				return pool.acquire()
+
+	def _submit(self, pool, jobs, running, batch):
+		job = {}
+		job["worker"] = self._acquire_worker(pool, jobs, running)
+		job["started"] = time.time()
+		job["size"] = len(batch)
+		finished_jobs = self._finished_jobs
+		job["bytes"] = pool.submit(job["worker"], self._task[1], batch, lambda jobinfo, nbytes: finished_jobs.put((job, jobinfo, nbytes)))
+		if self.ordered: #jobs are queued in order of submission
+			jobs.append(job)
+		conn = job["worker"]["connection"]
+		if not conn in running:
+			running[conn] = collections.deque() #our jobs queued at the worker in order of processing
+		running[conn].append(job)
 
-	def map(self, iterable):
+	def _update_chunksize(self, job):
+		"""Updates the optimal chunksize based on the processing times of the last 10*workers batches"""
+		processing_time = (job["stopped"] - job["started"])/max(1, job["size"])
+		self._processing_time_sum += processing_time - self._last_processing_times[self._last_processing_time_pos]
+		self._last_processing_times[self._last_processing_time_pos] = processing_time
+		self._last_processing_time_pos = (self._last_processing_time_pos + 1) % len(self._last_processing_times) #rotate through list with last processing times
+
+		avg_processing_time = max(self._processing_time_sum/len(self._last_processing_times), 1e-9)
+		desired_chunksize = int(math.ceil(self.chunkseconds/avg_processing_time)) #batch should take chunkseconds s to calculate
+		self._chunksize = min(desired_chunksize, max(10,2*self._chunksize)) #double chunksize at most every time (but allow to go to 10 directly in the beginning)
+
+		#limit chunksize by the serialized size of elements and results
+		element_bytes = float(job["bytes"])/max(1, job["size"])
+		self._element_bytes_sum += element_bytes - self._last_element_bytes[self._last_element_bytes_pos]
+		self._last_element_bytes[self._last_element_bytes_pos] = element_bytes
+		self._last_element_bytes_pos = (self._last_element_bytes_pos + 1) % len(self._last_element_bytes)
+		self._element_bytes_count = min(self._element_bytes_count + 1, len(self._last_element_bytes))
+
+		if self.chunkbytes != None:
+			avg_element_bytes = max(self._element_bytes_sum/self._element_bytes_count, 1.0)
+			self._chunksize = max(1, min(self._chunksize, int(self.chunkbytes/avg_element_bytes)))
+
+	def _finished_results(self, jobs):
+		"""Yields results while the leftmost job is finished"""
+		while len(jobs) > 0 and "stopped" in jobs[0]:
+			job = jobs.popleft()
+			self._update_chunksize(job)
+
+			if "error" in job:
+				ex_type, ex_value, tb_str = job["error"]
+				message = '%s (in subprocess)\n%s' % (str(ex_value), tb_str)
+				raise ex_type(message)
+
+			for r in job["results"]:
+				yield r
+
+	def _balanced_chunksize(self, length_hint, submitted):
+		"""Limits the chunksize such that the elements that are estimated to be left are spread over all workers"""
+		length = length_hint() if length_hint != None else None
+		if length == None:
+			return self._chunksize
+		remaining = max(1, length - submitted)
+		return max(1, min(self._chunksize, int(math.ceil(float(remaining)/self.num_workers))))
+
+	def map(self, iterable, length_hint = None):
 		"""Applies the map_func of the ParMap object to all elements in the iterable using parallel worker processes. The result is returned as a generator.
 		An optimal chunksize that is submitted to the workers is calculated dynamically.
 		Results are calculated on demand, meaning that you have to loop through the generator to continue processing.
@@ -128,214 +1113,70 @@ class ParMap(object):
 		
 		Args:
 			iterable: an iterable (list or generator) that map_func is applied to
+			length_hint: an optional function that returns the (estimated) number of elements in the iterable or None if unknown. 
+						 Chunks are kept small enough that the last elements are still divided among all workers.
 		"""
 		#initialize
-		workers = []
-		free_workers = queue.Queue()
-		self.request_stop = multiprocessing.Event()
+		if self.pool != None:
+			pool = self.pool
+		else:
+			pool = BACKENDS[self.backend](self.num_workers)
+		self._task = (pool, pool.register(self.map_func, self.context_func, self.transport, self.concurrency, self.combine_func))
 		self._chunksize = 1
 
-		#start up workers
-		for i in range(self.num_workers):
-			parent_conn, child_conn = multiprocessing.Pipe()
-			worker = {} 
-			worker["connection"] =  parent_conn
-			worker["process"] = Process(target = self._work, args=(child_conn, self.context_func))
-			workers.append(worker)
-			free_workers.put(worker)
-			worker["process"].start()
-
 		#process values
-		jobs = {}
-		jobid = 0
+		jobs = collections.deque() #jobs in the order their results are returned
+		running = {} #jobs that are still running by worker connection
+		self._finished_jobs = queue.Queue() #(job, jobinfo, size of results) of finished jobs, filled by the pool
 		batch = []
-		last_processing_times = [self.chunkseconds] * 10*self.num_workers #init with chunkseconds, such that intial chunksize is 1
-		last_processing_time_pos = 0
-
-		for value in iterable:
-			#wait as long as all workers are busy
-			while free_workers.empty():
-				minjobid = min(jobs.keys())
-				jobs[minjobid]["worker"]["connection"].poll(0.1)
-				for job in jobs.values():
-					if (not "stopped" in job) and job["worker"]["connection"].poll():
-						job.update(job["worker"]["connection"].recv())
-						free_workers.put(job["worker"])
-						job["worker"] = None
-
-			#if job limit reached, wait for leftmost job to finish
-			if len(jobs) >= 10*self.num_workers: #do not start jobs for more than 10*workers batches ahead to save memory
-				while not (self.job_is_finished(jobs[min(jobs.keys())], timeout = 0.1)):
-					pass
-
-			#yield results while leftmost batch is ready
-			while len(jobs) > 0 and (self.job_is_finished(jobs[min(jobs.keys())])): 
-				minjobid = min(jobs.keys())
-				if (not "stopped" in jobs[minjobid]) and jobs[minjobid]["worker"]["connection"].poll(): #FIXME: worker might have new job!!!!
-					jobs[minjobid].update(jobs[minjobid]["worker"]["connection"].recv())
-					free_workers.put(jobs[minjobid]["worker"])
-					jobs[minjobid]["worker"] = None
-
-				#update optimal chunksize based on 10*workers last batch processing times
-				last_processing_times[last_processing_time_pos] = (jobs[minjobid]["stopped"] - jobs[minjobid]["started"])/self._chunksize
-				last_processing_time_pos = (last_processing_time_pos + 1) % (10*self.num_workers) #rotate through list with last processing times
-
-				avg_processing_time = sum(last_processing_times)/len(last_processing_times)
-				desired_chunksize = int(math.ceil(self.chunkseconds/avg_processing_time)) #batch should take chunkseconds s to calculate
-				self._chunksize = min(desired_chunksize, max(10,2*self._chunksize)) #double chunksize at most every time (but allow to go to 10 directly in the beginning)
-				#print(self._chunksize)
-
-				if "error" in jobs[minjobid]:
-					self.request_stop.set()
-					#shutdown workers
-					for worker in workers:
-						try:
-							worker["connection"].send(None) #send shutdown command
-							worker["connection"].close()
-							worker["process"].join()
-						except Exception as e:
-							pass
-						
-					ex_type, ex_value, tb_str = jobs[minjobid]["error"]
-					message = '%s (in subprocess)\n%s' % (str(ex_value), tb_str)
-					raise ex_type(message)
-
-				for r in jobs[minjobid]["results"]:
-					yield r
-				del jobs[minjobid]
+		submitted = 0
+		self._last_processing_times = [self.chunkseconds] * 10*self.num_workers #init with chunkseconds, such that intial chunksize is 1
+		self._processing_time_sum = sum(self._last_processing_times)
+		self._last_processing_time_pos = 0
+		self._last_element_bytes = [0.0] * 10*self.num_workers
+		self._element_bytes_sum = 0.0
+		self._element_bytes_count = 0
+		self._last_element_bytes_pos = 0
 
-			#start new job if batch full
-			batch.append(value)
-
-			if len(batch) >= self._chunksize:
-				job = {}
-				jobs[jobid] = job
-				job["started"] = time.time()
-				job["worker"] = free_workers.get()
-				job["worker"]["connection"].send(batch)
-
-				batch = []
-				jobid += 1
-
-		#wait while all workers busy
-		while free_workers.empty():
-			minjobid = min(jobs.keys())
-			jobs[minjobid]["worker"]["connection"].poll(1)
-			for job in jobs.values():
-				if (not "stopped" in job) and job["worker"]["connection"].poll():
-					job.update(job["worker"]["connection"].recv())
-					free_workers.put(job["worker"])
-					job["worker"] = None
-
-		#submit last batch
-		if len(batch) > 0:
-			job = {}
-			jobs[jobid] = job
-			job["started"] = time.time()
-			job["worker"] = free_workers.get()
-			job["worker"]["connection"].send(batch)
-			batch = []
-
-		#wait for all jobs to finish
-		while len(jobs) > 0:
-			if (self.job_is_finished(jobs[min(jobs.keys())], timeout = 1.0)):
-				minjobid = min(jobs.keys())
-				if (not "stopped" in jobs[minjobid]) and jobs[minjobid]["worker"]["connection"].poll():
-					jobs[minjobid].update(jobs[minjobid]["worker"]["connection"].recv())
-					free_workers.put(jobs[minjobid]["worker"])
-					jobs[minjobid]["worker"] = None
-
-				if "error" in jobs[minjobid]:
-					self.request_stop.set()
-					#shutdown workers
-					for worker in workers:
-						try:
-							worker["connection"].send(None) #send shutdown command
-							worker["connection"].close()
-							worker["process"].join()
-						except Exception as e:
-							pass
-						
-					ex_type, ex_value, tb_str = jobs[minjobid]["error"]
-					message = '%s (in subprocess)\n%s' % (str(ex_value), tb_str)
-					raise ex_type(message)
-
-				for r in jobs[minjobid]["results"]:
+		try:
+			for value in iterable:
+				#yield results while leftmost batch is ready
+				for r in self._finished_results(jobs):
 					yield r
-				del jobs[minjobid]
 
-		#shutdown workers
-		for worker in workers:
-			try:
-				worker["connection"].send(None) #send shutdown command
-				worker["connection"].close()
-				worker["process"].join()
-			except Exception as e:
-				pass
+				#start new job if batch full
+				if len(batch) == 0: #decide the size of a batch when it is started, length_hint can be expensive
+					chunksize = self._balanced_chunksize(length_hint, submitted)
+				batch.append(value)
 
-	def _work(self, conn, context_func):
-		shutdown_requested = False
+				if len(batch) >= chunksize:
+					#if job limit reached, wait for leftmost job to finish (unordered jobs are only queued after they finished)
+					while len(jobs) >= 10*self.num_workers and not "stopped" in jobs[0]: #do not start jobs for more than 10*workers batches ahead to save memory
+						self._receive_finished(jobs, running, timeout = None)
 
-		if context_func != None:
-			try:
-				with context_func() as c:
-					while not shutdown_requested and not self.request_stop.is_set():
-						if conn.poll(1):
-							batch = conn.recv()
-							if batch != None:
-								self._map_batch(conn, batch, c)
-							else:
-								shutdown_requested = True
-			except Exception as e: #worker not initialized, return error for all incoming jobs
-				ex_type, ex_value, tb = sys.exc_info()
-				error = (ex_type, ex_value, ''.join(traceback.format_tb(tb)))
-
-				while not shutdown_requested and not self.request_stop.is_set():
-					if conn.poll(1):
-						batch = conn.recv()
-						if batch != None:
-							jobinfo = {}
-							jobinfo["error"] = error
-							jobinfo["stopped"] = time.time()
-							conn.send(jobinfo)
-							batch = conn.recv()
-						else:
-							shutdown_requested = True
-		else:
-			while not shutdown_requested and not self.request_stop.is_set():
-				if conn.poll(1):
-					batch = conn.recv()
-					if batch != None:
-						self._map_batch(conn, batch)
-					else:
-						shutdown_requested = True
-		conn.close()
+					self._submit(pool, jobs, running, batch)
+					submitted += len(batch)
+					batch = []
+					self._receive_finished(jobs, running)
 
-	def _map_batch(self, conn, batch, context = None):
-		results = []
-		for value in batch:
-			if self.request_stop.is_set():
-				jobinfo = {}
-				jobinfo["error"] = (Exception, "stop requested", "")
-				jobinfo["stopped"] = time.time()
-				conn.send(jobinfo)
-				return
-			try:
-				if context:
-					results.append(self.map_func(value, context))
-				else:
-					results.append(self.map_func(value))
-			except Exception as e:
-				ex_type, ex_value, tb = sys.exc_info()
-				error = ex_type, ex_value, ''.join(traceback.format_tb(tb))
-				
-				jobinfo = {}
-				jobinfo["error"] = error
-				jobinfo["stopped"] = time.time()
-				conn.send(jobinfo)
-				return
+			#submit last batch
+			if len(batch) > 0:
+				self._submit(pool, jobs, running, batch)
+				batch = []
+
+			#wait for all jobs to finish
+			while len(jobs) > 0 or len(running) > 0:
+				for r in self._finished_results(jobs):
+					yield r
+				self._receive_finished(jobs, running, timeout = None)
+		finally:
+			#stop and wait for jobs that are still running, e.g. after an error or if the generator was closed
+			if len(running) > 0:
+				pool.stop_task(self._task[1])
+				while len(running) > 0: #jobs of workers that have gone away are finished with an error
+					self._receive_finished(jobs, running, timeout = None)
+			pool.unregister(self._task[1])
+			self._task = None
 
-		jobinfo = {}
-		jobinfo["stopped"] = time.time()
-		jobinfo["results"] = results
-		conn.send(jobinfo)
+			if self.pool == None:
+				pool.close()
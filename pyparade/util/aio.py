@@ -0,0 +1,63 @@
+"""Support for coroutine functions (defined with async def) in `pyparade.util.ParMap`.
+Only imported by workers that run coroutine functions, as it requires Python 3.5+."""
+import asyncio, sys, time, traceback
+
+def get_loop(state):
+	"""Returns the event loop of a worker. The loop is created once per worker and kept until the worker shuts down, 
+	such that asynchronous contexts stay usable between batches."""
+	if state.get("loop") == None:
+		state["loop"] = asyncio.new_event_loop()
+	return state["loop"]
+
+def run(state, coroutine):
+	"""Runs a coroutine on the event loop of a worker and returns its result"""
+	return get_loop(state).run_until_complete(coroutine)
+
+def close(state):
+	"""Closes the event loop of a worker"""
+	if state.get("loop") != None:
+		state["loop"].close()
+		state["loop"] = None
+
+def map_batch(state, map_func, batch, use_context, context, stop_flags, slot, concurrency):
+	"""Applies the coroutine function map_func to all values in the batch with at most concurrency calls running at the same time.
+	Returns a jobinfo dictionary like `pyparade.util._map_batch`."""
+	return run(state, _map_batch(map_func, batch, use_context, context, stop_flags, slot, concurrency))
+
+class StopRequested(Exception):
+	pass
+
+async def _map_batch(map_func, batch, use_context, context, stop_flags, slot, concurrency):
+	semaphore = asyncio.Semaphore(concurrency)
+
+	async def call(value):
+		async with semaphore:
+			if stop_flags[slot]:
+				raise StopRequested("stop requested")
+			if use_context:
+				return await map_func(value, context)
+			else:
+				return await map_func(value)
+
+	calls = [asyncio.ensure_future(call(value)) for value in batch]
+	if len(calls) > 0:
+		done, pending = await asyncio.wait(calls, return_when=asyncio.FIRST_EXCEPTION)
+		if len(pending) > 0: #a call failed, cancel the remaining calls
+			for c in pending:
+				c.cancel()
+			await asyncio.wait(pending)
+
+	jobinfo = {}
+	for c in calls:
+		if not c.cancelled() and c.exception() != None:
+			e = c.exception()
+			if isinstance(e, StopRequested):
+				jobinfo["error"] = (Exception, "stop requested", "")
+			else:
+				jobinfo["error"] = (type(e), e, ''.join(traceback.format_tb(e.__traceback__)))
+			jobinfo["stopped"] = time.time()
+			return jobinfo
+
+	jobinfo["stopped"] = time.time()
+	jobinfo["results"] = [c.result() for c in calls]
+	return jobinfo
@@ -2,9 +2,47 @@ from builtins import zip
 from builtins import map
 from builtins import range
 import random
-import unittest, time, threading
+import unittest, time, threading, os, asyncio, tempfile, contextlib, subprocess, sys
 
-from pyparade.util import Event, ParMap, Timer
+from pyparade.util import Event, ParMap, Timer, WorkerPool, ThreadWorkerPool, SERIALIZERS, get_serializer, deserialize, estimate_size, stable_hash, MemoryBudget, ByteOffsetEstimator, FileSizeEstimator
+import pyparade.util
+
+class CountingContext(object):
+	"""Counts how often a context has been entered in the current process"""
+	entered = 0
+
+	def __enter__(self):
+		CountingContext.entered += 1
+		return CountingContext.entered
+
+	def __exit__(self, exc_type, exc_value, tb):
+		pass
+
+def pid_and_context(a, context):
+	return (os.getpid(), context, a)
+
+def add_one_slowly(a):
+	time.sleep(0.001)
+	return a + 1
+
+class AsyncContext(object):
+	"""Counts how many calls run at the same time"""
+	def __init__(self):
+		self.running = 0
+		self.max_running = 0
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, exc_type, exc_value, tb):
+		pass
+
+async def sleep_and_count(a, context):
+	context.running += 1
+	context.max_running = max(context.max_running, context.running)
+	await asyncio.sleep(0.05)
+	context.running -= 1
+	return (a + 1, context.max_running)
 
 class TestEvent(unittest.TestCase):
 	def test_fire_event(self):
@@ -34,6 +72,55 @@ class TestEvent(unittest.TestCase):
 
 		self.assertEqual(False, self.fired)
 
+class TestMemoryBudget(unittest.TestCase):
+	def test_estimate_size(self):
+		self.assertEqual(0, estimate_size([]))
+		size = estimate_size([bytes(bytearray([i]))*1000 for i in range(0,100)])
+		self.assertGreater(size, 100000)
+		self.assertLess(size, 110000)
+
+	def test_budget(self):
+		freed = []
+		budget = MemoryBudget(100)
+		budget.add_listener(lambda: freed.append(True))
+		budget.allocate(60)
+		self.assertFalse(budget.exceeded())
+		budget.allocate(60)
+		self.assertTrue(budget.exceeded())
+		budget.free(60)
+		self.assertFalse(budget.exceeded())
+		self.assertEqual([True], freed) #listeners are notified when the used memory drops below the limit
+
+	def test_length_estimators(self):
+		offset = [0]
+		estimator = ByteOffsetEstimator(1000, lambda: offset[0])
+		self.assertEqual(None, estimator(0))
+		offset[0] = 250
+		self.assertEqual(40, estimator(10))
+
+		with tempfile.TemporaryFile("w+") as f:
+			f.write("".join([str(i%10) + "\n" for i in range(0,100000)]))
+			f.seek(0)
+			estimator = FileSizeEstimator(f)
+			for i, line in enumerate(f):
+				if i == 50000:
+					self.assertAlmostEqual(100000, estimator(i), delta=10000) #text files are read ahead in chunks
+
+class TestStableHash(unittest.TestCase):
+	def test_stable_hash(self):
+		keys = [None, True, 2, 2.5, float("nan"), "word", b"bytes", ("word", 2, None), frozenset(["a", "b", 3])]
+		script = "import pyparade.util; print([pyparade.util.stable_hash(k) for k in " + repr(keys).replace("nan", "float('nan')") + "])"
+		root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(pyparade.util.__file__))))
+		env = dict(os.environ, PYTHONHASHSEED="1234", PYTHONPATH=root) #the built-in hash() of str and bytes differs with other seeds
+		output = subprocess.check_output([sys.executable, "-c", script], env=env, universal_newlines=True)
+		self.assertEqual(str([stable_hash(k) for k in keys]), output.strip())
+
+		self.assertEqual(stable_hash(1), stable_hash(1.0)) #equal keys belong to the same partition
+		self.assertEqual(stable_hash(1), stable_hash(True))
+		self.assertEqual(stable_hash(frozenset(["a", "b"])), stable_hash(frozenset(["b", "a"])))
+		self.assertRaises(TypeError, stable_hash, object())
+		self.assertRaises(TypeError, stable_hash, ("word", object()))
+
 class TestParMap(unittest.TestCase):
 	"""Tests parallelized map"""
 
@@ -93,3 +180,180 @@ class TestParMap(unittest.TestCase):
 			self.assertEqual(correct_value, calculated_value)
 		self.assertEqual(len(correct_values), len(calculated_values))
 
+	def test_shared_memory_transport(self):
+		def f(a):
+			return (a[0], a[1][::-1])
+
+		values = [(i, bytes(bytearray([i % 256]*1000)) + b"end") for i in range(0,1000)]
+		p = ParMap(f, num_workers=2, transport="shared_memory")
+		calculated_values = [v for v in p.map(values)]
+		correct_values = list(map(f,values))
+		self.assertEqual(correct_values, calculated_values)
+
+	def test_worker_pool(self):
+		with WorkerPool(2) as pool:
+			first = [v for v in ParMap(pid_and_context, context_func=CountingContext, pool=pool).map(list(range(1000)))]
+			second = [v for v in ParMap(pid_and_context, context_func=CountingContext, pool=pool).map(list(range(1000)))]
+			worker_pids = set(worker["process"].pid for worker in pool.workers)
+
+		self.assertEqual(list(range(1000)), [a for pid, context, a in first])
+		self.assertEqual(list(range(1000)), [a for pid, context, a in second])
+		#same workers are reused and contexts are only entered once per worker
+		self.assertEqual(2, len(worker_pids))
+		self.assertTrue(set(pid for pid, context, a in first + second).issubset(worker_pids))
+		self.assertEqual(set([1]), set(context for pid, context, a in first + second))
+
+	def test_unregister(self):
+		entered = []
+		exited = []
+
+		class Context(object):
+			def __enter__(self):
+				entered.append(self)
+				return self
+			def __exit__(self, exc_type, exc_value, tb):
+				exited.append(self)
+
+		with ThreadWorkerPool(2) as pool:
+			for run in range(0,3): #contexts of a context_func that cannot be registered again are exited when its task is unregistered
+				self.assertEqual(list(range(100)), [a for pid, context, a in ParMap(pid_and_context, context_func=Context, pool=pool).map(list(range(100)))])
+			list(ParMap(pid_and_context, context_func=contextlib.nullcontext, pool=pool).map(list(range(100)))) #stays open
+			for i in range(0,100):
+				if len(exited) == len(entered):
+					break
+				time.sleep(0.05)
+			self.assertGreater(len(entered), 2)
+			self.assertEqual(len(entered), len(exited))
+			self.assertEqual([set(), set()], [worker["tasks"] for worker in pool.workers])
+
+	def test_lost_worker(self):
+		with WorkerPool(1) as pool:
+			self.assertEqual(list(range(1,11)), list(ParMap(add_one_slowly, pool=pool).map(list(range(10)))))
+			lost = pool.workers[0]
+			lost["process"].kill()
+			lost["process"].join()
+			for i in range(0,100): #the pool replaces the worker when it notices that it has gone away
+				if pool.workers[0] is not lost:
+					break
+				time.sleep(0.05)
+			self.assertEqual(list(range(1,11)), list(ParMap(add_one_slowly, pool=pool).map(list(range(10)))))
+			self.assertTrue(pool.workers[0]["process"].is_alive())
+
+	def test_unordered(self):
+		def f(a):
+			if a == 0: #first batch is a straggler
+				time.sleep(2)
+			return a + 1
+
+		p = ParMap(f, num_workers=2, ordered=False)
+		calculated_values = [v for v in p.map(list(range(1000)))]
+		self.assertEqual(list(range(1,1001)), sorted(calculated_values))
+		self.assertNotEqual(1, calculated_values[0])
+
+	def test_prefetch(self):
+		def f(a):
+			time.sleep(0.0001)
+			return a + 1
+
+		for prefetch in [0, 3]:
+			p = ParMap(f, num_workers=2, prefetch=prefetch)
+			calculated_values = [v for v in p.map(list(range(10000)))]
+			self.assertEqual(list(range(1,10001)), calculated_values)
+			self.assertGreater(p.chunksize, 10)
+
+	def test_prefetch_suspended(self):
+		with WorkerPool(2) as pool:
+			watchdog = threading.Timer(120, pool.close) #waiting for a worker fails instead of hanging if the pool is closed
+			watchdog.start()
+			first = ParMap(add_one_slowly, pool=pool, prefetch=3).map(list(range(2000)))
+			self.assertEqual(1, next(first)) #generator is suspended with batches queued at all workers
+			#workers are handed back when their batches are finished, although the first generator is not resumed
+			second = ParMap(add_one_slowly, pool=pool, prefetch=3)
+			self.assertEqual(list(range(1,2001)), list(second.map(list(range(2000)))))
+			self.assertEqual(list(range(2,2001)), list(first))
+			watchdog.cancel()
+
+	def test_combine_timing(self):
+		def f(a):
+			return a + 1
+
+		def combine(results):
+			time.sleep(0.001*len(results)) #combining takes most of the processing time
+			return [sum(results)]
+
+		p = ParMap(f, num_workers=2, chunkseconds=0.1, combine_func=combine)
+		self.assertEqual(sum(range(1,5001)), sum(p.map(list(range(5000)))))
+		self.assertLess(p.chunksize, 400) #about 100 elements take chunkseconds
+
+	def test_threads(self):
+		contexts = []
+
+		class Context(object):
+			def __enter__(self):
+				contexts.append(threading.current_thread().name)
+				return self
+			def __exit__(self, exc_type, exc_value, tb):
+				pass
+
+		def f(a, context):
+			time.sleep(0.1) #waiting for I/O
+			return (a + 1, os.getpid(), id(context))
+
+		p = ParMap(f, num_workers=100, context_func=Context, backend="threads")
+		t_par = Timer("threads")
+		calculated_values = [v for v in p.map(list(range(1000)))]
+		t_par.stop()
+		self.assertEqual(list(range(1,1001)), [a for a, pid, context in calculated_values])
+		self.assertEqual(set([os.getpid()]), set(pid for a, pid, context in calculated_values))
+		self.assertEqual(len(contexts), len(set(context for a, pid, context in calculated_values))) #one context per thread
+		self.assertLess(t_par.seconds, 20)
+
+	def test_threads_unserialized(self):
+		locks = [threading.Lock() for i in range(0,1000)] #cannot be pickled
+		p = ParMap(lambda lock: (lock, threading.current_thread().name), num_workers=4, backend="threads")
+		calculated_values = list(p.map(locks))
+		self.assertTrue(all(lock is calculated for lock, (calculated, name) in zip(locks, calculated_values))) #elements and results are handed over as they are
+		self.assertEqual(set(["Worker"]), set(name for calculated, name in calculated_values))
+
+	def test_coroutine_function(self):
+		p = ParMap(sleep_and_count, num_workers=2, context_func=AsyncContext, concurrency=50)
+		t_par = Timer("async")
+		calculated_values = [v for v in p.map(list(range(2000)))]
+		t_par.stop()
+		self.assertEqual(list(range(1,2001)), [a for a, max_running in calculated_values])
+		self.assertLessEqual(max(max_running for a, max_running in calculated_values), 50)
+		self.assertGreater(max(max_running for a, max_running in calculated_values), 1)
+		self.assertLess(t_par.seconds, 20)
+
+	def test_chunkbytes(self):
+		def f(a):
+			return a[::-1]
+
+		values = [bytes(bytearray([i % 256]*100000)) for i in range(0,500)]
+		p = ParMap(f, num_workers=2, chunkbytes=1000000)
+		calculated_values = [v for v in p.map(values)]
+		self.assertEqual(list(map(f, values)), calculated_values)
+		self.assertLessEqual(p.chunksize, 5) #each element and result take 200kB
+
+		p = ParMap(f, num_workers=2, chunkbytes=None)
+		calculated_values = [v for v in p.map(values)]
+		self.assertGreater(p.chunksize, 5)
+
+	def test_serializers(self):
+		records = [(i, "word %d" % i, {"count": i, "text": "abc"*i}) for i in range(200)]
+		for name in SERIALIZERS:
+			with self.subTest(serializer=name):
+				if name == "cloudpickle" and pyparade.util.cloudpickle == None:
+					self.skipTest("cloudpickle is not installed")
+				self.assertEqual(records, deserialize(get_serializer(name).dumps(records)))
+				p = ParMap(pid_and_context, num_workers=2, context_func=CountingContext, serializer=name)
+				self.assertEqual(records, [a for pid, context, a in p.map(records)])
+
+	@unittest.skipIf(pyparade.util.cloudpickle == None, "cloudpickle is not installed")
+	def test_cloudpickle_lambda(self):
+		offset = 5
+		with WorkerPool(2) as pool:
+			list(ParMap(pid_and_context, context_func=CountingContext, pool=pool).map(list(range(10)))) #start workers
+			#the lambda is sent to running workers, which only works if it is pickled by value
+			p = ParMap(lambda a: a + offset, pool=pool, serializer="cloudpickle")
+			self.assertEqual(list(range(5,105)), list(p.map(list(range(100)))))
@@ -26,5 +26,8 @@ PyParade is a lightweight multiprocessing framework that makes it easy to parall
       zip_safe=True,
       install_requires=[
             'future>=0.18.2'
-      ]
+      ],
+      extras_require={
+            'cloudpickle': ['cloudpickle']
+      }
       )
\ No newline at end of file